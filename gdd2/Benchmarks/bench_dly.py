@@ -0,0 +1,88 @@
+'''Usage: bench_dly.py <dly_file(optional)> <repeat(optional)>
+Compare the vectorized .dly parser in Scripts/dly.py against the per-day
+Python loop that store_temperatures used to run, on the checked-in sample
+file data/USC00999999.dly (ten years of synthetic data in the GHCN layout)
+by default. Checks that both parsers produce the same records, apart from the
+days with a 0F minimum or maximum that only the vectorized parser keeps, then
+reports the best time of several runs for a full-history parse and for a
+nightly five-day window.'''
+import calendar, datetime, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Scripts'))
+import dly
+
+def parse_loop (station_id, text, begin_date, end_date):
+    '''The original parser from gdd.store_temperatures, kept as the baseline.
+It tests tmin and tmax for truth, so it drops days where either is exactly 0F'''
+    records = {}
+    for row in iter(text.splitlines()):
+        element = row[17:21].strip().lower()
+        if element != 'tmin' and element != 'tmax':
+            continue
+        year = int(row[11:15])
+        month = int(row[15:17])
+        end_of_month = datetime.date(year, month, 1) + datetime.timedelta(days=30)
+        beginning_of_month = datetime.date(year, month, 1) - datetime.timedelta(days=1)
+        if end_of_month < begin_date or beginning_of_month > end_date:
+            continue
+        for day,index in enumerate(xrange(21, 262, 8), start=1):
+            if day > calendar.monthrange(year, month)[1]:
+                continue
+            observation_date = datetime.date(year, month, day)
+            if observation_date not in records:
+                records[observation_date] = {}
+            if observation_date < begin_date:
+                continue
+            if observation_date > end_date:
+                break
+            celsius_tenths = int(row[index:index+5])
+            if celsius_tenths == -9999:
+                continue
+            fahrenheit = int(celsius_tenths * 0.9/5) + 32
+            records[observation_date][element] = fahrenheit
+    return [ (station_id, date, data['tmin'], data['tmax'])
+             for date, data in records.iteritems()
+             if data.get('tmin', None) and data.get('tmax', None) ]
+
+def best_time (repeat, function, *args):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        function(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main (argv=None):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'USC00999999.dly')
+    repeat = 5
+    if argv is not None and len(argv) > 0:
+        path = argv[0]
+    if argv is not None and len(argv) > 1:
+        repeat = int(argv[1])
+    station_id = os.path.splitext(os.path.basename(path))[0]
+    with open(path, 'rb') as file:
+        text = file.read()
+    last_row = text.splitlines()[-1]
+    last_date = datetime.date(int(last_row[11:15]), int(last_row[15:17]), 1)
+    last_date += datetime.timedelta(calendar.monthrange(last_date.year, last_date.month)[1] - 1)
+    cases = [ ('full history', datetime.date(1800, 1, 1), last_date),
+              ('five days', last_date - datetime.timedelta(4), last_date) ]
+    print '%s: %d bytes, %d rows' % (path, len(text), len(text.splitlines()))
+    for name, begin_date, end_date in cases:
+        expected = sorted((record[0], record[1].isoformat(), record[2], record[3])
+                          for record in parse_loop(station_id, text, begin_date, end_date))
+        actual = dly.parse(station_id, text, begin_date, end_date).tolist()
+        nonzero = [ record for record in actual if record[2] and record[3] ]
+        if nonzero != expected:
+            raise Exception('%s: parsers disagree (%d records from loop, %d vectorized)' % (name, len(expected), len(nonzero)))
+        loop_time = best_time(repeat, parse_loop, station_id, text, begin_date, end_date)
+        vector_time = best_time(repeat, dly.parse, station_id, text, begin_date, end_date)
+        print '%-12s %6d records (%d at 0F)   loop %8.2f ms   vectorized %8.2f ms   speedup %6.1fx' % \
+            (name, len(actual), len(actual) - len(nonzero), loop_time * 1000, vector_time * 1000, loop_time / vector_time)
+    return 0
+
+if __name__ == "__main__":
+    status = main(sys.argv[1:])
+    sys.exit(status)
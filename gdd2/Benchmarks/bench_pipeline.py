@@ -0,0 +1,160 @@
+'''Usage: bench_pipeline.py [options]
+Time the gdd2 pipeline end to end with no network access and no ArcGIS, on
+synthetic GHCN files from fixtures.py served by a ghcn.DirectorySource:
+
+  load_stations               stream and upsert the station inventory
+  ingest_backfill             bulk-load every station's full history
+  ingest_incremental          a nightly load of the last five days, which
+                              overlap the loaded range as gdd.py's do, so only
+                              the tails of the files are read
+  query_day_counts            the per-day observation counts main checks
+  query_count_observations    the same counts for the whole range in one query
+  query_observations          each day's observations joined to their stations
+  interpolate_cold            series.compute with an empty weight cache
+  interpolate_warm            series.compute again, with the cache filled
+  accumulate                  the running sum over the interpolated stack
+
+Each run appends a JSON line of its parameters and timings to
+Scratch/bench_results.jsonl (or the file given with --results), along with the
+timings recorded inside ghcn (fetch, parse, sqlite), and is compared with the
+previous run that used the same parameters, so regressions show up across
+changes.'''
+import datetime, json, logging, optparse, os, shutil, subprocess, sys, sqlite3, tempfile, time
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+# Results go with gdd.py's metrics, outside the tracked tree
+_RESULTS = os.path.join(_HERE, '..', 'Scratch', 'bench_results.jsonl')
+sys.path.insert(0, os.path.join(_HERE, '..', 'Scripts'))
+import fixtures, ghcn, idw, metrics, numpy, series
+
+# The grid and interpolation settings used by gdd.py
+_EXTENT = (-20000000, 1800000, -7000000, 11600000)
+_IDW_POWER = 2
+_IDW_NEIGHBORS = 10
+_IDW_RADIUS = 300000
+# Flag stages that got this much slower than the previous run, and by at least _NOISE seconds
+_REGRESSION = 0.10
+_NOISE = 0.05
+
+def git_revision ():
+    try:
+        process = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'], cwd=_HERE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return process.communicate()[0].strip() or None
+    except OSError:
+        return None
+
+def run (options, data_folder, work_folder):
+    '''Run each stage, timing it into the current metrics'''
+    last_year = datetime.date.today().year
+    begin_date = datetime.date(last_year - options.years + 1, 1, 1)
+    end_date = datetime.date(last_year, 12, 31)
+    source = ghcn.DirectorySource(data_folder)
+    db_conn = sqlite3.connect(os.path.join(work_folder, 'temperature.db'))
+    ghcn.create_tables(db_conn)
+    ghcn.create_watermark_table(db_conn)
+    with metrics.timer('load_stations'):
+        ghcn.load_stations(db_conn, source, last_year)
+    station_ids = [ row[0] for row in db_conn.execute('SELECT id FROM station') ]
+    with metrics.timer('ingest_backfill'):
+        with ghcn.bulk_load(db_conn):
+            ghcn.store_temperatures(db_conn, source, station_ids, begin_date, end_date,
+                                    options.workers, batch_size=500)
+    with metrics.timer('ingest_incremental'):
+        ghcn.store_temperatures(db_conn, source, station_ids, end_date - datetime.timedelta(4), end_date, options.workers)
+    # The interpolated range starts on January 1st, so it needs no previous totals
+    first_date = datetime.date(last_year, 1, 1)
+    dates = [ first_date + datetime.timedelta(index) for index in xrange(options.days) ]
+    with metrics.timer('query_day_counts'):
+        for date in dates:
+            db_conn.execute('SELECT COUNT (*) from temperature t WHERE t.date=?', (date,)).fetchone()
+    with metrics.timer('query_count_observations'):
+        db_conn.execute('SELECT t.date, COUNT (*) from temperature t WHERE t.date BETWEEN ? AND ? GROUP BY t.date',
+                        (dates[0], dates[-1])).fetchall()
+    with metrics.timer('query_observations'):
+        for date in dates:
+            db_conn.execute('SELECT s.id,s.x,s.y,t.tmax,t.tmin FROM temperature t INNER JOIN station s ON s.id=t.station WHERE t.date=?',
+                            (date,)).fetchall()
+    grid = idw.Grid(_EXTENT, options.cell_size)
+    weights = idw.WeightCache(os.path.join(work_folder, 'weights'), grid, _IDW_NEIGHBORS, _IDW_POWER, _IDW_RADIUS)
+    stack_path = os.path.join(work_folder, 'stack.npy')
+    for stage in ('interpolate_cold', 'interpolate_warm'):
+        with metrics.timer(stage):
+            stack, computed = series.compute(db_conn, dates[0], dates[-1], grid, 50, 86, weights, stack_path,
+                                             processes=options.processes)
+        del stack
+    metrics.count('cells_written', len(computed) * grid.rows * grid.cols)
+    daily = numpy.load(stack_path, mmap_mode='r')
+    stack = numpy.array(daily)
+    del daily
+    with metrics.timer('accumulate'):
+        series.accumulate(stack, computed)
+    db_conn.close()
+
+def previous_result (path, params):
+    '''Return the last result in the results file at path with the given parameters'''
+    previous = None
+    if os.path.exists(path):
+        with open(path, 'r') as file:
+            for line in file:
+                result = json.loads(line)
+                if result.get('params') == params:
+                    previous = result
+    return previous
+
+def compare (result, previous):
+    '''Print the result's timings next to the previous run's, flagging regressions'''
+    print '%-26s %10s %10s %8s' % ('stage', 'seconds', 'previous', 'change')
+    for stage, timing in sorted(result['timings'].items()):
+        seconds = timing['seconds']
+        before = previous['timings'].get(stage, {}).get('seconds') if previous is not None else None
+        if before is None:
+            print '%-26s %10.3f %10s %8s' % (stage, seconds, '-', '-')
+            continue
+        change = (seconds - before) / before if before > 0 else 0.0
+        flag = '  slower' if change > _REGRESSION and seconds - before > _NOISE else ''
+        print '%-26s %10.3f %10.3f %+7.1f%%%s' % (stage, seconds, before, change * 100, flag)
+
+def main (argv=None):
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option('-s', '--stations', type='int', default=500, help='number of synthetic stations')
+    parser.add_option('-y', '--years', type='int', default=2, help='years of history per station')
+    parser.add_option('-d', '--days', type='int', default=7, help='days to interpolate')
+    parser.add_option('-c', '--cell-size', type='int', default=10000,
+                      help='interpolation cell size in meters (gdd.py uses 5000)')
+    parser.add_option('-w', '--workers', type='int', default=8, help='download threads')
+    parser.add_option('-j', '--processes', type='int', default=1, help='interpolation processes')
+    parser.add_option('--data', help='folder for the synthetic files, kept and reused between runs')
+    parser.add_option('--results', default=os.path.normpath(_RESULTS),
+                      help='results file to append to (default Scratch/bench_results.jsonl)')
+    parser.add_option('--label', help='a note recorded with the result')
+    parser.add_option('-v', '--verbose', action='store_true', default=False)
+    options, args = parser.parse_args(argv or [])
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.DEBUG if options.verbose else logging.WARNING)
+    work_folder = tempfile.mkdtemp(prefix='gdd-bench-')
+    data_folder = options.data or os.path.join(work_folder, 'ghcn')
+    try:
+        if not os.path.exists(os.path.join(data_folder, 'ghcnd-inventory.txt')):
+            start = time.time()
+            fixtures.generate(data_folder, options.stations, options.years)
+            print 'generated %d stations x %d years in %.1f seconds' % (options.stations, options.years, time.time() - start)
+        metrics.reset()
+        run(options, data_folder, work_folder)
+    finally:
+        shutil.rmtree(work_folder, True)
+    params = { 'stations': options.stations, 'years': options.years, 'days': options.days,
+               'cell_size': options.cell_size, 'workers': options.workers, 'processes': options.processes }
+    previous = previous_result(options.results, params)
+    result = metrics.current().report(params=params, revision=git_revision(), label=options.label)
+    compare(result, previous)
+    results_folder = os.path.dirname(os.path.abspath(options.results))
+    if not os.path.exists(results_folder):
+        os.makedirs(results_folder)
+    with open(options.results, 'a') as file:
+        file.write(json.dumps(result, sort_keys=True) + '\n')
+    return 0
+
+if __name__ == "__main__":
+    status = main(sys.argv[1:])
+    sys.exit(status)
@@ -0,0 +1,95 @@
+'''Usage: fixtures.py <folder> <stations(optional)> <years(optional)>
+Generate a synthetic copy of the GHCN daily files that gdd.py reads: a
+ghcnd-inventory.txt listing the given number of US stations, and a .dly file of
+PRCP, TMAX and TMIN rows for each of them covering the given number of years up
+to the current one. Stations are scattered over the contiguous United States,
+with seasonal temperatures that vary with latitude, random noise and a few
+missing days. A ghcn.DirectorySource over the folder stands in for the NCDC
+server, so the pipeline can be run and timed with no network access.'''
+import datetime, numpy, os, sys
+
+_ELEMENTS = ('PRCP', 'TMAX', 'TMIN')
+_DAYS_IN_MONTH = numpy.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+def station_ids (count):
+    return [ 'USC%08d' % index for index in xrange(count) ]
+
+def encode_values (values, width=5):
+    '''Return an array of character codes holding each of the integer values
+right-aligned in a field of width characters'''
+    magnitude = numpy.abs(values)
+    digits = numpy.floor(numpy.log10(numpy.maximum(magnitude, 1))).astype(numpy.int64) + 1
+    chars = numpy.empty(values.shape + (width,), numpy.uint8)
+    for position in xrange(width):
+        place = width - 1 - position
+        chars[..., position] = numpy.where(place < digits, (magnitude // 10 ** place) % 10 + ord('0'), ord(' '))
+    negative = numpy.nonzero(values < 0)
+    chars[negative + (width - 1 - digits[negative],)] = ord('-')
+    return chars
+
+def dly_text (station_id, lat, first_year, last_year, random):
+    '''Return the contents of a synthetic .dly file for one station'''
+    years = numpy.arange(first_year, last_year + 1).repeat(12)
+    months = numpy.tile(numpy.arange(1, 13), last_year - first_year + 1)
+    leap = (years % 4 == 0) & ((years % 100 != 0) | (years % 400 == 0))
+    days_in_month = _DAYS_IN_MONTH[months - 1] + (leap & (months == 2))
+    day = numpy.arange(1, 32)
+    day_of_year = (numpy.cumsum(numpy.concatenate(([ 0 ], _DAYS_IN_MONTH[:-1])))[months - 1])[:, numpy.newaxis] + day
+    # Temperatures in tenths of a degree Celsius, warmer in the south and in summer
+    mean = 250 - 10 * (lat - 25) + (120 + 4 * (lat - 25)) * numpy.sin(2 * numpy.pi * (day_of_year - 105) / 365.0)
+    tmax = numpy.round(mean + random.normal(0, 40, mean.shape)).astype(numpy.int64)
+    tmin = tmax - numpy.round(80 + random.uniform(0, 60, mean.shape)).astype(numpy.int64)
+    prcp = numpy.where(random.uniform(0, 1, mean.shape) < 0.7, 0, random.randint(1, 400, mean.shape))
+    rows = []
+    for element, values in zip(_ELEMENTS, (prcp, tmax, tmin)):
+        values = values.copy()
+        values[(day > days_in_month[:, numpy.newaxis]) | (random.uniform(0, 1, values.shape) < 0.02)] = -9999
+        chars = numpy.empty((len(years), 269), numpy.uint8)
+        chars.fill(ord(' '))
+        chars[:, 0:11] = numpy.frombuffer(station_id, numpy.uint8)
+        chars[:, 11:15] = encode_values(years, 4)
+        chars[:, 15:17] = encode_values(months, 2)
+        chars[:, 15:17][chars[:, 15:17] == ord(' ')] = ord('0')
+        chars[:, 17:21] = numpy.frombuffer(element, numpy.uint8)
+        chars[:, 21:].reshape(len(years), 31, 8)[:, :, :5] = encode_values(values)
+        rows.append(chars)
+    # Rows are ordered by month, then element, as in the real files
+    chars = numpy.concatenate([ row[:, numpy.newaxis] for row in rows ], axis=1).reshape(-1, 269)
+    lines = numpy.empty((len(chars), 270), numpy.uint8)
+    lines[:, :269] = chars
+    lines[:, 269] = ord('\n')
+    return lines.tostring()
+
+def generate (folder, stations=500, years=2, last_year=None, seed=0):
+    '''Write ghcnd-inventory.txt and a .dly file for each of stations synthetic
+stations to folder, covering years years up to last_year (by default the
+current year). Returns the list of station ids'''
+    if last_year is None:
+        last_year = datetime.date.today().year
+    first_year = last_year - years + 1
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    random = numpy.random.RandomState(seed)
+    ids = station_ids(stations)
+    lats = random.uniform(25, 49, stations)
+    lons = random.uniform(-124, -67, stations)
+    with open(os.path.join(folder, 'ghcnd-inventory.txt'), 'w') as inventory:
+        for station_id, lat, lon in zip(ids, lats, lons):
+            for element in _ELEMENTS:
+                inventory.write('%-11s %8.4f %9.4f %-4s %4d %4d\n' % (station_id, lat, lon, element, first_year, last_year))
+            with open(os.path.join(folder, station_id + '.dly'), 'wb') as dly:
+                dly.write(dly_text(station_id, lat, first_year, last_year, random))
+    return ids
+
+def main (argv=None):
+    if argv is None or len(argv) < 1:
+        print __doc__
+        return 1
+    stations = int(argv[1]) if len(argv) > 1 else 500
+    years = int(argv[2]) if len(argv) > 2 else 2
+    generate(argv[0], stations, years)
+    return 0
+
+if __name__ == "__main__":
+    status = main(sys.argv[1:])
+    sys.exit(status)
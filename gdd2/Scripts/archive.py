@@ -0,0 +1,253 @@
+'''Storage for the cumulative growing degree day time series as a chunked,
+compressed (time, y, x) array, as an alternative to one raster per day.
+
+The archive is a Zarr (version 2) group, so it can be opened by any Zarr
+reader, but is read and written here with nothing more than NumPy and zlib.
+Array "0" holds the series at full resolution and arrays "1", "2", ... hold
+overviews at successively halved resolutions. Each chunk holds a short run of
+days for a block of cells, so a time series for one point touches only a
+handful of chunks, as does a map of one day at an overview level. Archives
+created without compression store chunks as raw arrays, which are memory
+mapped when read. The days that have been written are recorded in the group's
+attributes as ranges of time indices, so the days in a gap left along the time
+axis don't count as present.'''
+import datetime, json, numpy, os, zlib
+
+NODATA = 65535
+_DTYPE = numpy.dtype('<u2')
+
+class ZarrArray(object):
+    '''A three dimensional uint16 Zarr array stored in a directory, one file per chunk'''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, '.zarray'), 'r') as file:
+            self.meta = json.load(file)
+        self.shape = tuple(self.meta['shape'])
+        self.chunks = tuple(self.meta['chunks'])
+        self.compressor = self.meta['compressor']
+
+    @classmethod
+    def create (cls, path, shape, chunks, compression=5):
+        '''Create an empty array. compression is the zlib level, or None to store
+chunks uncompressed'''
+        if not os.path.exists(path):
+            os.makedirs(path)
+        meta = { 'zarr_format': 2,
+                 'shape': list(shape),
+                 'chunks': list(chunks),
+                 'dtype': _DTYPE.str,
+                 'compressor': None if compression is None else { 'id': 'zlib', 'level': compression },
+                 'fill_value': NODATA,
+                 'order': 'C',
+                 'filters': None }
+        with open(os.path.join(path, '.zarray'), 'w') as file:
+            json.dump(meta, file, indent=2)
+        return cls(path)
+
+    def resize (self, length):
+        '''Extend the time axis to length'''
+        if length > self.shape[0]:
+            self.meta['shape'][0] = length
+            self.shape = tuple(self.meta['shape'])
+            with open(os.path.join(self.path, '.zarray'), 'w') as file:
+                json.dump(self.meta, file, indent=2)
+
+    def _chunk_path (self, index):
+        return os.path.join(self.path, '.'.join(str(i) for i in index))
+
+    def read_chunk (self, index):
+        '''Return the chunk at the given (time, row, column) chunk index. Chunks that
+were never written are filled with NODATA'''
+        path = self._chunk_path(index)
+        if not os.path.exists(path):
+            chunk = numpy.empty(self.chunks, _DTYPE)
+            chunk.fill(NODATA)
+            return chunk
+        if self.compressor is None:
+            return numpy.memmap(path, _DTYPE, 'r', shape=self.chunks)
+        with open(path, 'rb') as file:
+            data = zlib.decompress(file.read())
+        return numpy.frombuffer(data, _DTYPE).reshape(self.chunks)
+
+    def write_chunk (self, index, chunk):
+        data = numpy.ascontiguousarray(chunk, _DTYPE).tostring()
+        if self.compressor is not None:
+            data = zlib.compress(data, self.compressor.get('level', 5))
+        with open(self._chunk_path(index), 'wb') as file:
+            file.write(data)
+
+    def _chunk_ranges (self, start, stop):
+        '''Yield (chunk index, chunk start, chunk stop) for the chunks along each axis
+that overlap the block from start to stop'''
+        ranges = []
+        for axis in xrange(3):
+            size = self.chunks[axis]
+            ranges.append([ (i, i * size, (i + 1) * size)
+                            for i in xrange(start[axis] // size, (stop[axis] - 1) // size + 1) ])
+        for t in ranges[0]:
+            for r in ranges[1]:
+                for c in ranges[2]:
+                    yield (t, r, c)
+
+    def read (self, start, stop):
+        '''Return the block of the array from the (time, row, column) start up to stop'''
+        stop = [ min(stop[axis], self.shape[axis]) for axis in xrange(3) ]
+        block = numpy.empty([ max(stop[axis] - start[axis], 0) for axis in xrange(3) ], _DTYPE)
+        if block.size == 0:
+            return block
+        for ranges in self._chunk_ranges(start, stop):
+            chunk = self.read_chunk([ index for index, lo, hi in ranges ])
+            source = [ slice(max(start[axis], ranges[axis][1]) - ranges[axis][1],
+                             min(stop[axis], ranges[axis][2]) - ranges[axis][1]) for axis in xrange(3) ]
+            target = [ slice(max(start[axis], ranges[axis][1]) - start[axis],
+                             min(stop[axis], ranges[axis][2]) - start[axis]) for axis in xrange(3) ]
+            block[tuple(target)] = chunk[tuple(source)]
+        return block
+
+    def write (self, start, block):
+        '''Write block into the array with its first cell at the (time, row, column)
+start, extending the time axis if needed. Chunks the block only partly covers
+are read and updated'''
+        self.resize(start[0] + block.shape[0])
+        stop = [ min(start[axis] + block.shape[axis], self.shape[axis]) for axis in xrange(3) ]
+        for ranges in self._chunk_ranges(start, stop):
+            index = [ i for i, lo, hi in ranges ]
+            covered = all(start[axis] <= ranges[axis][1] and stop[axis] >= ranges[axis][2] for axis in xrange(3))
+            chunk = numpy.empty(self.chunks, _DTYPE) if covered else numpy.array(self.read_chunk(index))
+            target = [ slice(max(start[axis], ranges[axis][1]) - ranges[axis][1],
+                             min(stop[axis], ranges[axis][2]) - ranges[axis][1]) for axis in xrange(3) ]
+            source = [ slice(max(start[axis], ranges[axis][1]) - start[axis],
+                             min(stop[axis], ranges[axis][2]) - start[axis]) for axis in xrange(3) ]
+            if covered:
+                chunk.fill(NODATA)
+            chunk[tuple(target)] = block[tuple(source)]
+            self.write_chunk(index, chunk)
+
+def to_stored (values):
+    '''Convert an array of growing degree days to stored values, with NaN cells as NODATA'''
+    values = numpy.asarray(values, numpy.float32)
+    stored = numpy.clip(numpy.round(numpy.nan_to_num(values)), 0, NODATA - 1).astype(_DTYPE)
+    stored[numpy.isnan(values)] = NODATA
+    return stored
+
+def downsample (block):
+    '''Halve the resolution of a (time, rows, cols) block of stored values by
+averaging each 2x2 group of cells, ignoring NODATA'''
+    days, rows, cols = block.shape
+    padded = numpy.empty((days, rows + rows % 2, cols + cols % 2), _DTYPE)
+    padded.fill(NODATA)
+    padded[:, :rows, :cols] = block
+    groups = padded.reshape(days, padded.shape[1] // 2, 2, padded.shape[2] // 2, 2)
+    valid = groups != NODATA
+    count = valid.sum(axis=4).sum(axis=2)
+    total = numpy.where(valid, groups, 0).astype(numpy.float64).sum(axis=4).sum(axis=2)
+    result = numpy.round(total / numpy.maximum(count, 1)).astype(_DTYPE)
+    result[count == 0] = NODATA
+    return result
+
+class Archive(object):
+    '''A time series of daily grids, one day per step along the time axis from the
+archive's origin date. Grid geometry is recorded with the archive so that map
+coordinates can be converted to rows and columns'''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, '.zattrs'), 'r') as file:
+            self.attrs = json.load(file)
+        self.origin = datetime.datetime.strptime(self.attrs['origin'], '%Y-%m-%d').date()
+        self.extent = tuple(self.attrs['extent'])
+        self.cell_size = self.attrs['cell_size']
+        self.levels = [ ZarrArray(os.path.join(path, dataset['path']))
+                        for dataset in self.attrs['multiscales'][0]['datasets'] ]
+        # Archives from before written days were recorded have no gaps
+        self.written = [ tuple(span) for span in self.attrs.get('written', [ [ 0, self.levels[0].shape[0] ] ])
+                         if span[1] > span[0] ]
+
+    @classmethod
+    def create (cls, path, origin, grid, chunks=(16, 256, 256), levels=4, compression=5):
+        '''Create an empty archive for days from origin onwards on the given
+idw.Grid. compression is the zlib level, or None for uncompressed,
+memory-mappable chunks. Spatial chunk sizes must be divisible by 2 ** (levels - 1)'''
+        if not os.path.exists(path):
+            os.makedirs(path)
+        with open(os.path.join(path, '.zgroup'), 'w') as file:
+            json.dump({ 'zarr_format': 2 }, file)
+        rows, cols = grid.shape
+        datasets = []
+        for level in xrange(levels):
+            ZarrArray.create(os.path.join(path, str(level)), (0, rows, cols), chunks, compression)
+            datasets.append({ 'path': str(level) })
+            rows, cols = (rows + 1) // 2, (cols + 1) // 2
+        attrs = { 'multiscales': [ { 'version': '0.1', 'datasets': datasets } ],
+                  'origin': origin.isoformat(),
+                  'extent': [ grid.xmin, grid.ymin, grid.xmax, grid.ymax ],
+                  'cell_size': grid.cell_size,
+                  'nodata': NODATA,
+                  'written': [] }
+        with open(os.path.join(path, '.zattrs'), 'w') as file:
+            json.dump(attrs, file, indent=2)
+        return cls(path)
+
+    def index (self, date):
+        '''Return the position of date along the time axis'''
+        index = (date - self.origin).days
+        if index < 0:
+            raise Exception('%s is before the start of the archive at %s' % (date.isoformat(), self.origin.isoformat()))
+        return index
+
+    def has_day (self, date):
+        '''Return True if date has been written to the archive'''
+        if date < self.origin:
+            return False
+        index = self.index(date)
+        return any(start <= index < stop for start, stop in self.written)
+
+    def _add_written (self, start, stop):
+        '''Record the days from time index start up to stop as written'''
+        spans = sorted(self.written + [ (start, stop) ])
+        merged = [ spans[0] ]
+        for span in spans[1:]:
+            if span[0] <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], span[1]))
+            else:
+                merged.append(span)
+        self.written = merged
+        self.attrs['written'] = [ list(span) for span in merged ]
+        with open(os.path.join(self.path, '.zattrs'), 'w') as file:
+            json.dump(self.attrs, file, indent=2)
+
+    def write (self, begin_date, stack, chunk_rows=None):
+        '''Write a (days, rows, cols) stack of cumulative growing degree days for
+consecutive dates from begin_date, with NaN for cells with no data, at full
+resolution and at every overview level'''
+        if stack.ndim == 2:
+            stack = stack[numpy.newaxis]
+        t0 = self.index(begin_date)
+        time_chunk = self.levels[0].chunks[0]
+        if chunk_rows is None:
+            chunk_rows = self.levels[0].chunks[1]
+        for d0 in xrange(0, stack.shape[0], time_chunk):
+            d1 = min(d0 + time_chunk, stack.shape[0])
+            for row0 in xrange(0, stack.shape[1], chunk_rows):
+                block = to_stored(stack[d0:d1, row0:row0 + chunk_rows])
+                row = row0
+                for level in self.levels:
+                    level.write((t0 + d0, row, 0), block)
+                    block = downsample(block)
+                    row //= 2
+        self._add_written(t0, t0 + stack.shape[0])
+
+    def read (self, begin_date, end_date, rows, cols, level=0):
+        '''Return the (days, rows, cols) block of stored values for dates from
+begin_date to end_date inclusive and the given (start, stop) ranges of rows and
+columns at the given overview level'''
+        t0, t1 = self.index(begin_date), self.index(end_date) + 1
+        return self.levels[level].read((t0, rows[0], cols[0]), (t1, rows[1], cols[1]))
+
+    def day (self, date, level=0):
+        '''Return the grid of stored values for one date at the given level'''
+        array = self.levels[level]
+        return self.read(date, date, (0, array.shape[1]), (0, array.shape[2]), level)[0]
+
+    def series (self, row, col, begin_date, end_date, level=0):
+        '''Return the stored values for one cell for each date from begin_date to end_date'''
+        return self.read(begin_date, end_date, (row, row + 1), (col, col + 1), level)[:, 0, 0]
@@ -0,0 +1,94 @@
+'''Vectorized parsing of Global Historical Climate Network daily (.dly) files.
+Each row of a .dly file holds one element (TMAX, TMIN, PRCP, ...) for one month
+as 31 fixed-width day values. Rather than walking rows and days in Python, the
+whole file is viewed as a 2-D array of characters and decoded with NumPy.'''
+import numpy
+
+ROW_LENGTH = 269
+MISSING = -9999
+TEMPERATURE = numpy.dtype([('station', 'S11'), ('date', 'S10'), ('tmin', 'i2'), ('tmax', 'i2')])
+_DAYS_IN_MONTH = numpy.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+def read_rows (text):
+    '''Return the rows of a .dly file as a 2-D array of character codes'''
+    line_length = ROW_LENGTH + 1
+    if len(text) % line_length == 0 and text[ROW_LENGTH::line_length].count('\n') == len(text) // line_length:
+        # Every row is complete and newline terminated, so the text can be used as is
+        return numpy.frombuffer(text, numpy.uint8).reshape(-1, line_length)[:, :ROW_LENGTH]
+    lines = text.splitlines()
+    return numpy.array(lines, 'S%d' % ROW_LENGTH).view(numpy.uint8).reshape(len(lines), ROW_LENGTH)
+
+def decode_integers (chars):
+    '''Decode right-aligned, optionally negative integers from an array of
+character codes, where the last axis holds the characters of each field'''
+    digits = chars.astype(numpy.int32) - ord('0')
+    digits[(digits < 0) | (digits > 9)] = 0
+    weights = 10 ** numpy.arange(chars.shape[-1] - 1, -1, -1)
+    values = (digits * weights).sum(axis=-1)
+    return numpy.where((chars == ord('-')).any(axis=-1), -values, values)
+
+def encode_dates (year, month, day):
+    '''Return an array of YYYY-MM-DD strings for the given year, month and day arrays'''
+    chars = numpy.empty((len(year), 10), numpy.uint8)
+    for position, (values, scale) in enumerate(((year, 1000), (year, 100), (year, 10), (year, 1),
+                                                (None, 0), (month, 10), (month, 1),
+                                                (None, 0), (day, 10), (day, 1))):
+        if values is None:
+            chars[:, position] = ord('-')
+        else:
+            chars[:, position] = (values // scale) % 10 + ord('0')
+    return chars.view('S10').ravel()
+
+def parse (station_id, text, begin_date=None, end_date=None):
+    '''Parse the contents of a station's .dly file, returning a structured array
+of TEMPERATURE records, in degrees Fahrenheit, for each day between begin_date
+and end_date (both optional and inclusive) that has both a minimum and maximum
+temperature. Unlike the per-day loop it replaced, which tested the values for
+truth, days with a minimum or maximum of exactly 0F are kept. The result's
+tolist() can be passed straight to executemany'''
+    rows = read_rows(text)
+    element = numpy.ascontiguousarray(rows[:, 17:21]).view('S4').ravel()
+    is_tmax = element == 'TMAX'
+    rows = rows[is_tmax | (element == 'TMIN')]
+    is_tmax = is_tmax[is_tmax | (element == 'TMIN')]
+    if len(rows) == 0:
+        return numpy.empty(0, TEMPERATURE)
+    months = decode_integers(rows[:, 11:15]) * 12 + decode_integers(rows[:, 15:17]) - 1
+    if begin_date is not None:
+        keep = months >= begin_date.year * 12 + begin_date.month - 1
+        rows, months, is_tmax = rows[keep], months[keep], is_tmax[keep]
+    if end_date is not None:
+        keep = months <= end_date.year * 12 + end_date.month - 1
+        rows, months, is_tmax = rows[keep], months[keep], is_tmax[keep]
+    if len(rows) == 0:
+        return numpy.empty(0, TEMPERATURE)
+    # Day values are 5 characters followed by three flag characters
+    values = decode_integers(rows[:, 21:21 + 31 * 8].reshape(len(rows), 31, 8)[:, :, :5])
+    # Scatter the rows into dense (month, day) grids so each day's minimum and
+    # maximum line up, whatever order the rows were in
+    first = months.min()
+    count = months.max() - first + 1
+    tmin = numpy.empty((count, 31), numpy.int32)
+    tmin.fill(MISSING)
+    tmax = tmin.copy()
+    tmax[months[is_tmax] - first] = values[is_tmax]
+    tmin[months[~is_tmax] - first] = values[~is_tmax]
+    grid_months = numpy.arange(first, first + count)
+    year = grid_months // 12
+    month = grid_months % 12 + 1
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    days_in_month = _DAYS_IN_MONTH[month - 1] + (leap & (month == 2))
+    day = numpy.arange(1, 32)
+    valid = (tmin != MISSING) & (tmax != MISSING) & (day <= days_in_month[:, numpy.newaxis])
+    stamp = (year * 10000 + month * 100)[:, numpy.newaxis] + day
+    if begin_date is not None:
+        valid &= stamp >= begin_date.year * 10000 + begin_date.month * 100 + begin_date.day
+    if end_date is not None:
+        valid &= stamp <= end_date.year * 10000 + end_date.month * 100 + end_date.day
+    month_index, day_index = numpy.nonzero(valid)
+    result = numpy.empty(len(month_index), TEMPERATURE)
+    result['station'] = station_id
+    result['date'] = encode_dates(year[month_index], month[month_index], day_index + 1)
+    result['tmin'] = numpy.trunc(tmin[valid] * 0.9 / 5) + 32
+    result['tmax'] = numpy.trunc(tmax[valid] * 0.9 / 5) + 32
+    return result
@@ -1,7 +1,23 @@
-import arcpy, calendar, csv, datetime, httplib, io, json, logging, math, os, re, sqlite3, sys, urllib
+import arcpy, archive, calendar, csv, datetime, ghcn, httplib, idw, io, json, logging, math, metrics, numpy, optparse, os, re, series, sqlite3, sys, urllib
 
 _DBCONN = None
+_SCRATCH_FOLDER = None
+_SOURCE = None
+_FETCH_WORKERS = 8
+_BULK_LOAD_DAYS = 31
+_BULK_LOAD_BATCH = 500
 _MOSAIC = 'growing_degree_days'
+_EXTENT = (-20000000, 1800000, -7000000, 11600000)
+_CELL_SIZE = 5000
+_GRID = idw.Grid(_EXTENT, _CELL_SIZE)
+# Interpolate with the NumPy engine in idw.py ('numpy'), or with arcpy.sa.Idw ('arcpy')
+_ENGINE = 'numpy'
+_IDW_POWER = 2
+_IDW_NEIGHBORS = 10
+_IDW_RADIUS = 300000
+_WEIGHT_CACHE = None
+_ARCHIVE_PATH = None
+_ARCHIVE = None
 logger = logging.getLogger('gdd')
 
 def setup_environment():
@@ -13,7 +29,7 @@ def setup_environment():
     sr = arcpy.SpatialReference()
     sr.loadFromString(r'PROJCS["WGS_1984_Web_Mercator_Auxiliary_Sphere",GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137.0,298.257223563]],PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]],PROJECTION["Mercator_Auxiliary_Sphere"],PARAMETER["False_Easting",0.0],PARAMETER["False_Northing",0.0],PARAMETER["Central_Meridian",0.0],PARAMETER["Standard_Parallel_1",0.0],PARAMETER["Auxiliary_Sphere_Type",0.0],UNIT["Meter",1.0],AUTHORITY["EPSG",3857]]')
     arcpy.env.outputCoordinateSystem = sr
-    arcpy.env.extent = arcpy.Extent(-20000000, 1800000, -7000000, 11600000)
+    arcpy.env.extent = arcpy.Extent(*_EXTENT)
     arcpy.env.rasterStatistics = 'STATISTICS'
     arcpy.env.overwriteOutput = True
     # Create a scratch geodatabase for storing intermediate results
@@ -21,6 +37,8 @@ def setup_environment():
     scratch_folder = os.path.join(root_folder, 'Scratch')
     if not os.path.exists(scratch_folder):
         os.makedirs(scratch_folder)
+    global _SCRATCH_FOLDER
+    _SCRATCH_FOLDER = scratch_folder
     scratch_gdb = os.path.join(scratch_folder, 'scratch.gdb')
     if not os.path.exists(scratch_gdb):
         logger.debug('creating scratch.gdb')
@@ -35,108 +53,104 @@ def setup_environment():
         logger.debug('creating data.gdb')
         arcpy.management.CreateFileGDB(data_folder, 'data.gdb')
     arcpy.env.workspace = results_gdb
+    # The chunked time series archive lives alongside the geodatabase, and is
+    # created on first use
+    global _ARCHIVE_PATH
+    _ARCHIVE_PATH = os.path.join(data_folder, 'gdd.zarr')
+    # Read GHCN data from the NCDC server, or from the local directory or host
+    # named by the GHCN_SOURCE environment variable
+    global _SOURCE
+    _SOURCE = ghcn.open_source(os.environ.get('GHCN_SOURCE'))
     # Create a raster catalog in the results geodatabase to store our time series data
     if not arcpy.Exists(_MOSAIC):
         logger.debug('creating %s', _MOSAIC)
         arcpy.management.CreateMosaicDataset(results_gdb, _MOSAIC, sr, 1, '16_BIT_UNSIGNED')
         arcpy.management.AddField(_MOSAIC, 'BeginDate', 'DATE')
         arcpy.management.AddField(_MOSAIC, 'EndDate', 'DATE')
+    # Cache interpolation weights for the station sets we've already seen
+    global _WEIGHT_CACHE
+    _WEIGHT_CACHE = idw.WeightCache(os.path.join(scratch_folder, 'weights'), _GRID,
+                                    _IDW_NEIGHBORS, _IDW_POWER, _IDW_RADIUS)
     # Create an sqlite database to hold the temperature station data, and open a connection to it
     temperature_db = os.path.join(scratch_folder, 'temperature.db')
-    if not os.path.exists(temperature_db):
-        logger.debug('creating temperature.db')
-        create_temperature_database(temperature_db)
+    new_database = not os.path.exists(temperature_db)
     global _DBCONN
     _DBCONN = sqlite3.connect(temperature_db)
+    ghcn.create_tables(_DBCONN)
+    ghcn.create_watermark_table(_DBCONN)
+    if new_database:
+        logger.debug('creating temperature.db')
+        load_stations()
 
-def create_temperature_database (path):
-    '''Create an sqlite database for storing temperature station data. Load the station
-id and location information from the Global Historical Climate Network's data inventory file'''
-    logger.debug('creating database file and tables')
-    db_conn = sqlite3.connect(path)
-    db_cursor = db_conn.cursor()
-    db_cursor.execute('CREATE TABLE station (id VARCHAR(11) NOT NULL, x INT NOT NULL, y INT NOT NULL, PRIMARY KEY (id));')
-    db_cursor.execute('''CREATE TABLE temperature (station VARCHAR(11) NOT NULL REFERENCES station(id), 
-                                                   tmin INT NOT NULL, 
-                                                   tmax INT NOT NULL, 
-                                                   date DATE NOT NULL,
-                                                   PRIMARY KEY (station,date));''')
-    db_cursor.execute('CREATE INDEX temperature_station_index ON temperature (station);')
-    db_cursor.execute('CREATE INDEX temperature_date_index ON temperature (date);')
-    db_conn.commit()
-    current_year = datetime.datetime.now().year
-    stations = []
-    logger.debug('loading station data from ncdc.noaa.gov')
-    response = http_get('www1.ncdc.noaa.gov', '/pub/data/ghcn/daily/ghcnd-inventory.txt')
-    for row in iter(response.splitlines()):
-        id = row[0:11].strip()
-        lat = float(row[12:20])
-        lon = float(row[21:30])
-        data = row[31:35].strip()
-        first_year = int(row[36:40])
-        last_year = int(row[41:45])
-        if id[0:2] == 'US' and data == 'TMAX' and last_year == current_year:
-            x = 6378137.0 * lon * 0.017453292519943295
-            a = lat * 0.017453292519943295
-            y = 3189068.5 * math.log((1.0 + math.sin(a)) / (1.0 - math.sin(a)))
-            stations.append((id, int(x), int(y),))
-    logger.debug('loaded %s stations' % len(stations))
-    db_cursor.executemany('INSERT INTO station (id,x,y) VALUES (?, ?, ?)', stations)
-    db_conn.commit()
-    db_cursor.close()
+@metrics.timed('load_stations')
+def load_stations ():
+    '''Load the station id and location information from the Global Historical
+Climate Network's data inventory file into the temperature database. Stations
+already in the database are updated, so this can be run again to refresh them'''
+    logger.debug('loading station data from %s', ghcn.INVENTORY_PATH)
+    return ghcn.load_stations(_DBCONN, _SOURCE)
 
-def store_temperatures (begin_date, end_date):
-    '''Download temperature data from National Climate Data Center's Global Historical Climate Network dataset'''
+@metrics.timed('store_temperatures')
+def store_temperatures (begin_date, end_date, bulk=None, refresh=False):
+    '''Download temperature data from National Climate Data Center's Global Historical Climate Network dataset.
+Loads of more than _BULK_LOAD_DAYS days, or any load when bulk is True, run in
+bulk-load mode, committing many stations per transaction and deferring index
+maintenance until the end. With refresh, every station's data for the range is
+downloaded again, ignoring what has already been stored'''
     logger.debug('loading data between %s and %s from ncdc.noaa.gov', begin_date.isoformat(), end_date.isoformat())
     db_cursor = _DBCONN.cursor()
     db_cursor.execute('SELECT id FROM station')
-    count = 0
-    for record in db_cursor.fetchall():
-        station_id = record[0]
-        try:
-            response = http_get('www1.ncdc.noaa.gov', '/pub/data/ghcn/daily/all/%s.dly' % station_id)
-            records = {}
-            for row in iter(response.splitlines()):
-                element = row[17:21].strip().lower()
-                if element != 'tmin' and element != 'tmax': 
-                    continue
-                year = int(row[11:15])
-                month = int(row[15:17])
-                end_of_month = datetime.date(year, month, 1) + datetime.timedelta(days=30)
-                beginning_of_month = datetime.date(year, month, 1) - datetime.timedelta(days=1)
-                if end_of_month < begin_date or beginning_of_month > end_date:
-                    continue
-                for day,index in enumerate(xrange(21, 262, 8), start=1):
-                    if day > calendar.monthrange(year, month)[1]:
-                        continue
-                    observation_date = datetime.date(year, month, day)
-                    if observation_date not in records:
-                        records[observation_date] = {}
-                    if observation_date < begin_date:
-                        continue
-                    if observation_date > end_date:
-                        break
-                    celsius_tenths = int(row[index:index+5])
-                    if celsius_tenths == -9999:
-                        continue
-                    fahrenheit = int(celsius_tenths * 0.9/5) + 32
-                    records[observation_date][element] = fahrenheit
-                db_cursor.executemany('REPLACE INTO temperature (station,date,tmin,tmax) VALUES (?, ?, ?, ?)',
-                                      [ (station_id, date, data['tmin'], data['tmax'])
-                                        for date, data in records.iteritems()
-                                        if data.get('tmin', None) and data.get('tmax', None) ])
-                count += db_cursor.rowcount
-        except httplib.HTTPException:
-            logger.error('error loading data for station %s', station_id)
-        _DBCONN.commit()
+    station_ids = [ record[0] for record in db_cursor.fetchall() ]
     db_cursor.close()
+    if bulk is None:
+        bulk = (end_date - begin_date).days >= _BULK_LOAD_DAYS
+    if bulk:
+        logger.debug('using bulk-load mode')
+        with ghcn.bulk_load(_DBCONN):
+            count = ghcn.store_temperatures(_DBCONN, _SOURCE, station_ids, begin_date, end_date,
+                                            _FETCH_WORKERS, refresh, batch_size=_BULK_LOAD_BATCH)
+    else:
+        count = ghcn.store_temperatures(_DBCONN, _SOURCE, station_ids, begin_date, end_date, _FETCH_WORKERS, refresh)
     logger.debug('loaded %s observations', count)
 
-def create_gdd_raster (date, min_temp, max_temp):
-    '''Create a raster of growing degree days for the given date. Assumes
-that temperature data for that date has already been loaded into the
-database'''
-    logger.debug('creating raster for %s', date.isoformat())
+def get_weights ():
+    '''Return the source of interpolators: the weight cache if there is one'''
+    if _WEIGHT_CACHE is not None:
+        return _WEIGHT_CACHE
+    return idw.InterpolatorFactory(_GRID, _IDW_NEIGHBORS, _IDW_POWER, _IDW_RADIUS)
+
+def get_interpolator (ids, xy):
+    '''Return an interpolator for the stations with the given ids and locations'''
+    return get_weights().interpolator(ids, xy)
+
+def read_observations (date):
+    '''Return arrays of the station ids, station coordinates, maximum temperatures
+and minimum temperatures of all observations for the given date'''
+    db_cursor = _DBCONN.cursor()
+    db_cursor.execute('SELECT s.id,s.x,s.y,t.tmax,t.tmin FROM temperature t INNER JOIN station s ON s.id=t.station WHERE t.date=?', (date,))
+    rows = db_cursor.fetchall()
+    db_cursor.close()
+    ids = numpy.array([ row[0] for row in rows ], 'S11')
+    records = numpy.array([ row[1:] for row in rows ], numpy.float64).reshape(-1, 4)
+    return ids, records[:, 0:2], records[:, 2], records[:, 3]
+
+@metrics.timed('interpolate')
+def interpolate_temperatures (date):
+    '''Interpolate the maximum and minimum temperatures for the given date with the
+NumPy engine, returning a (tmax, tmin) pair of rasters. The nearest stations
+and their weights are found once per cell and used for both, and are reused
+from the weight cache when the same stations have been interpolated before'''
+    ids, xy, tmax, tmin = read_observations(date)
+    logger.debug('interpolating %s points', len(xy))
+    grids = get_interpolator(ids, xy).interpolate({ 'tmax': tmax, 'tmin': tmin })
+    corner = arcpy.Point(_GRID.xmin, _GRID.ymin)
+    return (arcpy.NumPyArrayToRaster(grids['tmax'], corner, _CELL_SIZE, _CELL_SIZE, idw.NODATA),
+            arcpy.NumPyArrayToRaster(grids['tmin'], corner, _CELL_SIZE, _CELL_SIZE, idw.NODATA),)
+
+@metrics.timed('interpolate')
+def interpolate_temperatures_arcpy (date):
+    '''Interpolate the maximum and minimum temperatures for the given date with
+arcpy.sa.Idw, returning a (tmax, tmin) pair of rasters'''
     feature_class = arcpy.management.CreateFeatureclass("in_memory", "temp", "POINT")
     arcpy.management.AddField(feature_class, 'tmin', 'SHORT')
     arcpy.management.AddField(feature_class, 'tmax', 'SHORT')
@@ -157,9 +171,22 @@ database'''
     db_cursor.close()
     del fc_cursor
     logger.debug('interpolating %s points', rcount)
+    tmax_ras = arcpy.sa.Idw(feature_class, 'tmax', _CELL_SIZE, _IDW_POWER, arcpy.sa.RadiusVariable(_IDW_NEIGHBORS, _IDW_RADIUS))
+    tmin_ras = arcpy.sa.Idw(feature_class, 'tmin', _CELL_SIZE, _IDW_POWER, arcpy.sa.RadiusVariable(_IDW_NEIGHBORS, _IDW_RADIUS))
+    arcpy.management.Delete(feature_class)
+    return tmax_ras, tmin_ras
+
+@metrics.timed('create_gdd_raster')
+def create_gdd_raster (date, min_temp, max_temp):
+    '''Create a raster of growing degree days for the given date. Assumes
+that temperature data for that date has already been loaded into the
+database'''
+    logger.debug('creating raster for %s', date.isoformat())
     arcpy.CheckOutExtension("Spatial")
-    tmax_ras = arcpy.sa.Idw(feature_class, 'tmax', 5000, 2, arcpy.sa.RadiusVariable(10, 300000))
-    tmin_ras = arcpy.sa.Idw(feature_class, 'tmin', 5000, 2, arcpy.sa.RadiusVariable(10, 300000))
+    if _ENGINE == 'arcpy':
+        tmax_ras, tmin_ras = interpolate_temperatures_arcpy(date)
+    else:
+        tmax_ras, tmin_ras = interpolate_temperatures(date)
     temp_range = max_temp - min_temp
     gdd_ras = arcpy.sa.Minus(arcpy.sa.Divide(arcpy.sa.Plus(tmax_ras, tmin_ras), 2), min_temp)
     gdd_ras = arcpy.sa.Con(gdd_ras < 0, 0, gdd_ras)
@@ -168,85 +195,256 @@ database'''
     prev_ras = prev_day.strftime('GDD_%Y%m%d')
     if arcpy.Exists(prev_ras) and (date.month != 1 or date.day != 1):
         gdd_ras = arcpy.sa.Plus(gdd_ras, prev_ras)
+    # Round to whole degree days, as series.accumulate and the archive do,
+    # rather than leave it to CopyRaster's conversion to 16 bits
+    gdd_ras = arcpy.sa.Int(arcpy.sa.Plus(gdd_ras, 0.5))
     out_ras = date.strftime('GDD_%Y%m%d')
-    arcpy.management.CopyRaster(gdd_ras, out_ras, "DEFAULTS", "", 65535, "", "", "16_BIT_UNSIGNED")
-    arcpy.management.Delete(feature_class)
-    arcpy.management.Delete(gdd_ras)
+    with metrics.timer('copy_raster'):
+        arcpy.management.CopyRaster(gdd_ras, out_ras, "DEFAULTS", "", 65535, "", "", "16_BIT_UNSIGNED")
+        arcpy.management.Delete(gdd_ras)
+    metrics.count('cells_written', _GRID.rows * _GRID.cols)
     arcpy.CheckInExtension("Spatial")
     return out_ras
 
+def get_archive (date):
+    '''Return the time series archive, creating it with its time axis starting on
+January 1st of date's year if it doesn't exist yet'''
+    global _ARCHIVE
+    if _ARCHIVE is None:
+        if os.path.exists(os.path.join(_ARCHIVE_PATH, '.zattrs')):
+            _ARCHIVE = archive.Archive(_ARCHIVE_PATH)
+        else:
+            logger.debug('creating %s', _ARCHIVE_PATH)
+            _ARCHIVE = archive.Archive.create(_ARCHIVE_PATH, datetime.date(date.year, 1, 1), _GRID)
+    return _ARCHIVE
+
+def gdd_exists (date, output='mosaic'):
+    '''Return True if growing degree days for the given date have already been
+written to the given output, which is one of mosaic, archive or both'''
+    exists = True
+    if output in ('mosaic', 'both'):
+        exists = exists and arcpy.Exists(date.strftime('GDD_%Y%m%d'))
+    if output in ('archive', 'both'):
+        exists = exists and get_archive(date).has_day(date)
+    return exists
+
+def read_previous (date, output='mosaic'):
+    '''Return the cumulative growing degree days for the day before date as a
+float32 array with NaN for no data, or None if they restart on date or there
+are none. Reads from the archive when writing to it, or from the previous
+day's raster'''
+    prev_day = date - datetime.timedelta(1)
+    if date.month == 1 and date.day == 1:
+        return None
+    if output != 'mosaic' and gdd_exists(prev_day, 'archive'):
+        previous = get_archive(date).day(prev_day).astype(numpy.float32)
+    elif arcpy.Exists(prev_day.strftime('GDD_%Y%m%d')):
+        corner = arcpy.Point(_GRID.xmin, _GRID.ymin)
+        previous = arcpy.RasterToNumPyArray(prev_day.strftime('GDD_%Y%m%d'), corner, _GRID.cols, _GRID.rows, 65535).astype(numpy.float32)
+    else:
+        return None
+    previous[previous == 65535] = numpy.nan
+    return previous
+
+@metrics.timed('create_gdd_rasters')
+def create_gdd_rasters (begin_date, end_date, min_temp, max_temp, processes=1, output='mosaic'):
+    '''Create growing degree day rasters for every date from begin_date to end_date
+in one batch, using the NumPy engine. Reads all of the range's observations with
+one query and accumulates the daily totals in memory, rather than reading each
+previous day's raster back from the geodatabase. Days are interpolated on a pool
+of processes when processes is greater than one. With output 'archive' or
+'both', the whole range is also written to the time series archive, and with
+'archive' no rasters are created. Returns a list of (raster, date) pairs for the
+rasters created'''
+    logger.debug('creating rasters for %s to %s', begin_date.isoformat(), end_date.isoformat())
+    previous = read_previous(begin_date, output)
+    stack_path = os.path.join(_SCRATCH_FOLDER, 'gdd_stack.npy')
+    with metrics.timer('interpolate'):
+        stack, dates = series.compute(_DBCONN, begin_date, end_date, _GRID, min_temp, max_temp,
+                                      get_weights(), stack_path, previous, processes)
+    if output in ('archive', 'both') and len(dates) > 0:
+        logger.debug('writing %s days to archive', len(dates))
+        with metrics.timer('archive_write'):
+            get_archive(begin_date).write(begin_date, stack)
+        metrics.count('cells_written', len(dates) * _GRID.rows * _GRID.cols)
+    rasters = []
+    corner = arcpy.Point(_GRID.xmin, _GRID.ymin)
+    for index, date in enumerate(dates):
+        if output == 'archive':
+            break
+        out_ras = date.strftime('GDD_%Y%m%d')
+        logger.debug('writing raster %s', out_ras)
+        gdd = numpy.where(numpy.isnan(stack[index]), idw.NODATA, stack[index])
+        with metrics.timer('copy_raster'):
+            gdd_ras = arcpy.NumPyArrayToRaster(gdd, corner, _CELL_SIZE, _CELL_SIZE, idw.NODATA)
+            arcpy.management.CopyRaster(gdd_ras, out_ras, "DEFAULTS", "", 65535, "", "", "16_BIT_UNSIGNED")
+            arcpy.management.Delete(gdd_ras)
+        metrics.count('cells_written', _GRID.rows * _GRID.cols)
+        rasters.append((out_ras, date))
+    del stack
+    os.remove(stack_path)
+    return rasters
+
 def add_gdd_raster_to_mosaic (gdd_img, date):
     '''Add the given growing degree day raster for the given date to the master
 raster catalog, and mark it as beloning to that date'''
-    rows = arcpy.UpdateCursor(_MOSAIC, "Name = '%s'" % gdd_img)
+    add_gdd_rasters_to_mosaic([ (gdd_img, date) ])
+
+@metrics.timed('add_gdd_rasters_to_mosaic')
+def add_gdd_rasters_to_mosaic (rasters):
+    '''Add a batch of growing degree day rasters, given as (raster, date) pairs, to
+the master raster catalog, and mark each as belonging to its date. Existing
+copies are removed in one cursor pass, the rasters are registered in one call
+that builds pyramids and statistics for the new items only, and the dates are
+set in one more cursor pass'''
+    if len(rasters) == 0:
+        return
+    dates = dict(rasters)
+    where = 'Name IN (%s)' % ', '.join("'%s'" % gdd_img for gdd_img, date in rasters)
+    rows = arcpy.UpdateCursor(_MOSAIC, where)
     for row in rows:
-        logger.debug('removing existing raster %s', gdd_img)
+        logger.debug('removing existing raster %s', row.Name)
         rows.deleteRow(row)
     del rows
-    logger.debug('adding raster %s to mosaic', gdd_img)
-    arcpy.management.AddRastersToMosaicDataset(_MOSAIC, 'Raster Dataset', gdd_img, \
+    logger.debug('adding %s rasters to mosaic', len(rasters))
+    arcpy.management.AddRastersToMosaicDataset(_MOSAIC, 'Raster Dataset', ';'.join(gdd_img for gdd_img, date in rasters), \
                                                'UPDATE_CELL_SIZES', 'UPDATE_BOUNDARY', 'NO_OVERVIEWS', \
                                                '#', '#', '#', '#', '#', '#', '#', \
                                                'BUILD_PYRAMIDS', 'CALCULATE_STATISTICS', 'BUILD_THUMBNAILS')
-    rows = arcpy.UpdateCursor(_MOSAIC, "Name = '%s'" % gdd_img)
-    end_date = date + datetime.timedelta(1)
+    rows = arcpy.UpdateCursor(_MOSAIC, where)
     for row in rows:
+        date = dates[row.Name]
+        end_date = date + datetime.timedelta(1)
         row.BeginDate = "%s/%s/%s" % (date.month, date.day, date.year,)
         row.EndDate = "%s/%s/%s" % (end_date.month, end_date.day, end_date.year,)
         rows.updateRow(row)
     del rows
 
-def http_get (host, path):
-    conn = httplib.HTTPConnection(host)
-    conn.request('GET', path)
-    response = conn.getresponse()
-    if response.status == 200:
-        return response.read()
-    else:
-        raise httplib.HTTPException()
+def count_observations (begin_date, end_date):
+    '''Return a dictionary mapping each date from begin_date to end_date that has
+temperature observations to the number it has'''
+    db_cursor = _DBCONN.cursor()
+    db_cursor.execute('SELECT t.date, COUNT (*) from temperature t WHERE t.date BETWEEN ? AND ? GROUP BY t.date', (begin_date, end_date))
+    counts = dict((datetime.datetime.strptime(date, '%Y-%m-%d').date(), count) for date, count in db_cursor.fetchall())
+    db_cursor.close()
+    return counts
 
 def main (argv=None):
-    '''Usage: <script> <begin_date(optional)> <end_date(optional)>
+    '''Usage: <script> [--batch [--processes N]] [--output mosaic|archive|both] [--refresh-stations]
+               [--refresh] [--metrics PATH] [--profile STAGE] <begin_date(optional)> <end_date(optional)>
 create growing degree day rasters for each day between begin_date 
 (which defaults to five days ago) and end_date (which defaults to 
 today), inclusive. Dates should be given in YYYY-MM-DD format. Will
 only create rasters for days that don't already have one, and only
-if at least 3000 temperature observations are available.'''
+if at least 3000 temperature observations are available. With --batch,
+the whole range is interpolated and accumulated in one pass before any
+rasters are written, which is much faster for long ranges, and with
+--processes the days are interpolated in parallel on N processes.
+--output archive writes the days to the chunked time series archive in
+ToolData/gdd.zarr instead of the mosaic, and --output both writes to
+both; either implies --batch. The archive starts on January 1st of the
+first year written to it, and can't take earlier dates. --refresh-stations
+reloads the station inventory before running, and --refresh downloads the
+temperature data for the range again even where it has already been
+stored. Each run appends a JSON line with the time spent in each stage
+and counts of the work done to Scratch/metrics.jsonl, or to the file given
+with --metrics, and --profile STAGE profiles one stage, such as
+store_temperatures or create_gdd_raster.'''
+    parser = optparse.OptionParser(usage=main.__doc__)
+    parser.add_option('-b', '--batch', action='store_true', default=False,
+                      help='compute the whole date range in one batch')
+    parser.add_option('-j', '--processes', type='int', default=1,
+                      help='number of processes to interpolate with in batch mode')
+    parser.add_option('-o', '--output', type='choice', choices=['mosaic', 'archive', 'both'], default='mosaic',
+                      help='where to write growing degree days: mosaic (default), archive or both')
+    parser.add_option('-s', '--refresh-stations', action='store_true', default=False,
+                      help='reload the station inventory before running')
+    parser.add_option('-r', '--refresh', action='store_true', default=False,
+                      help='download temperature data for the range again, even if already stored')
+    parser.add_option('-m', '--metrics', metavar='PATH',
+                      help='append a JSON line of stage timings and counters for the run to PATH '
+                           '(default Scratch/metrics.jsonl)')
+    parser.add_option('-p', '--profile', metavar='STAGE',
+                      help='profile the named stage with cProfile, writing Scratch/profile_STAGE.prof')
+    options, args = parser.parse_args(argv or [])
+    if options.output != 'mosaic':
+        options.batch = True
     setup_environment()
+    metrics.reset(options.profile)
+    status = 'error'
+    try:
+        result = run(options, args)
+        status = 'ok'
+        return result
+    finally:
+        report_path = options.metrics or os.path.join(_SCRATCH_FOLDER, 'metrics.jsonl')
+        metrics.current().write(report_path, argv=list(argv or []), status=status)
+        if options.profile:
+            metrics.current().write_profile(os.path.join(_SCRATCH_FOLDER, 'profile_%s.prof' % options.profile))
+
+def run (options, args):
+    '''Run the pipeline for the options and arguments parsed by main'''
+    if options.refresh_stations:
+        load_stations()
     begin_date = datetime.date.today() - datetime.timedelta(5)
     end_date = datetime.date.today()
-    if argv is not None and len(argv) > 0:
-        begin_date = datetime.datetime.strptime(argv[0], '%Y-%m-%d').date()
-    if argv is not None and len(argv) > 1:
-        end_date = datetime.datetime.strptime(argv[1], '%Y-%m-%d').date()
+    if len(args) > 0:
+        begin_date = datetime.datetime.strptime(args[0], '%Y-%m-%d').date()
+    if len(args) > 1:
+        end_date = datetime.datetime.strptime(args[1], '%Y-%m-%d').date()
     if end_date < begin_date:
         raise Exception('begin_date must be before end_date')
+    if options.output != 'mosaic' and begin_date < get_archive(begin_date).origin:
+        # Checked now, rather than when writing after the whole ingest and interpolation
+        raise Exception('beginning date %s is before the start of the archive at %s' %
+                        (begin_date.isoformat(), get_archive(begin_date).origin.isoformat()))
     if begin_date.month != 1 or begin_date.day != 1:
         prev_date = begin_date - datetime.timedelta(1)
-        if not arcpy.Exists(prev_date.strftime('GDD_%Y%m%d')):
+        previous_exists = arcpy.Exists(prev_date.strftime('GDD_%Y%m%d')) or \
+            (options.output != 'mosaic' and gdd_exists(prev_date, 'archive'))
+        if not previous_exists:
             raise Exception('beginning date %s is not the first day of year and previous day has no data' % begin_date.isoformat())
     logger.info('running gdd script for %s to %s' % (begin_date.isoformat(), end_date.isoformat()))
-    while arcpy.Exists(begin_date.strftime('GDD_%Y%m%d')) and begin_date <= end_date:
+    while gdd_exists(begin_date, options.output) and begin_date <= end_date:
         logger.debug('raster already exists for %s' % begin_date)
         begin_date = begin_date + datetime.timedelta(1)
     if begin_date > end_date:
         return 0
-    store_temperatures(begin_date, end_date)
-    db_cursor = _DBCONN.cursor()
-    current_date = begin_date
-    while current_date <= end_date:
-        db_cursor.execute('SELECT COUNT (*) from temperature t WHERE t.date=?', (current_date,))
-        if db_cursor.fetchone()[0] < 3000:
-            logger.debug('insufficient data to create raster for %s' % current_date)
-            break
-        raster = create_gdd_raster(current_date, 50, 86)
-        add_gdd_raster_to_mosaic(raster, current_date)
-        current_date = current_date + datetime.timedelta(1)
-    db_cursor.close()
+    store_temperatures(begin_date, end_date, refresh=options.refresh)
+    rasters = []
+    try:
+        if options.batch:
+            counts = count_observations(begin_date, end_date)
+            last_date = begin_date - datetime.timedelta(1)
+            while last_date < end_date and counts.get(last_date + datetime.timedelta(1), 0) >= 3000:
+                last_date = last_date + datetime.timedelta(1)
+            if last_date < end_date:
+                logger.debug('insufficient data to create raster for %s' % (last_date + datetime.timedelta(1)))
+            if last_date >= begin_date:
+                rasters = create_gdd_rasters(begin_date, last_date, 50, 86, options.processes, options.output)
+        else:
+            db_cursor = _DBCONN.cursor()
+            current_date = begin_date
+            while current_date <= end_date:
+                db_cursor.execute('SELECT COUNT (*) from temperature t WHERE t.date=?', (current_date,))
+                if db_cursor.fetchone()[0] < 3000:
+                    logger.debug('insufficient data to create raster for %s' % current_date)
+                    break
+                rasters.append((create_gdd_raster(current_date, 50, 86), current_date))
+                current_date = current_date + datetime.timedelta(1)
+            db_cursor.close()
+    finally:
+        # Register whatever was created, even if a later day failed, so that
+        # rasters aren't left out of the mosaic when the next run skips them
+        add_gdd_rasters_to_mosaic(rasters)
+    if len(rasters) == 0:
+        return 0
+    # Pyramids and statistics for the new rasters were built as they were added,
+    # so only the mosaic's own statistics need updating
     logger.debug('updating mosaic statistics')
-    arcpy.management.CalculateStatistics(_MOSAIC)
-    arcpy.management.BuildPyramidsandStatistics(_MOSAIC, 'INCLUDE_SUBDIRECTORIES', 'BUILD_PYRAMIDS', 'CALCULATE_STATISTICS')
-    arcpy.RefreshCatalog(_MOSAIC)
+    with metrics.timer('statistics'):
+        arcpy.management.CalculateStatistics(_MOSAIC)
+        arcpy.RefreshCatalog(_MOSAIC)
     return 0
 
 if __name__ == "__main__":
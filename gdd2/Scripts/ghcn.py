@@ -0,0 +1,425 @@
+'''Access to the daily data files of the Global Historical Climate Network (GHCN).
+Data can be read over HTTP from ncdc.noaa.gov, or from a local directory holding
+copies of the same files for offline runs and benchmarks.'''
+import contextlib, datetime, dly, email.utils, httplib, logging, metrics, numpy, os, Queue, random, re, socket, threading, time
+
+GHCN_HOST = 'www1.ncdc.noaa.gov'
+GHCN_PATH = '/pub/data/ghcn/daily'
+INVENTORY_PATH = GHCN_PATH + '/ghcnd-inventory.txt'
+INVENTORY = numpy.dtype([('id', 'S11'), ('lat', 'f8'), ('lon', 'f8'), ('element', 'S4'),
+                         ('first_year', 'i2'), ('last_year', 'i2')])
+_INVENTORY_LENGTH = 45
+logger = logging.getLogger('gdd.ghcn')
+
+class HTTPError(httplib.HTTPException):
+    '''A request that completed with a status other than 200 OK'''
+    def __init__(self, status, reason):
+        httplib.HTTPException.__init__(self, '%s %s' % (status, reason))
+        self.status = status
+        self.reason = reason
+
+class Resource(object):
+    '''The contents of a file, or of its tail from offset onwards, together with
+the validators needed to make a conditional request for it later'''
+    def __init__(self, body, offset=0, size=None, etag=None, modified=None):
+        self.body = body
+        self.offset = offset
+        self.size = len(body) + offset if size is None else size
+        self.etag = etag
+        self.modified = modified
+
+class HttpSource(object):
+    '''Read files from an HTTP server. Each thread that uses the source gets its
+own persistent connection, which is kept alive and reused for every request
+that thread makes'''
+    def __init__(self, host, timeout=60):
+        self.host = host
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def get(self, path, offset=0, etag=None, modified=None):
+        '''Return a Resource holding the file at path, starting at byte offset, or
+None if it is unchanged since the request that returned the given etag and
+modified validators'''
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+        if etag:
+            headers['If-None-Match'] = etag
+        if modified:
+            headers['If-Modified-Since'] = modified
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = httplib.HTTPConnection(self.host, timeout=self.timeout)
+            self._local.conn = conn
+        try:
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            body = response.read()
+        except (httplib.HTTPException, socket.error):
+            # The server may have dropped an idle keep-alive connection, so
+            # discard this one and let the next request open a fresh one
+            conn.close()
+            self._local.conn = None
+            raise
+        if response.status == 304:
+            return None
+        if response.status == 416:
+            # The file is shorter than it was, so it must have been rewritten
+            return self.get(path)
+        if response.status == 206:
+            match = re.match(r'bytes (\d+)-\d+/(\d+)', response.getheader('content-range', ''))
+            if match is None:
+                raise HTTPError(response.status, 'invalid Content-Range')
+            offset, size = int(match.group(1)), int(match.group(2))
+        elif response.status == 200:
+            offset, size = 0, len(body)
+        else:
+            raise HTTPError(response.status, response.reason)
+        return Resource(body, offset, size, response.getheader('etag'), response.getheader('last-modified'))
+
+    def open(self, path):
+        '''Return a file-like object streaming the file at path. Uses a connection
+of its own, since the response holds it until it has been read and closed'''
+        conn = httplib.HTTPConnection(self.host, timeout=self.timeout)
+        conn.request('GET', path)
+        response = conn.getresponse()
+        if response.status != 200:
+            conn.close()
+            raise HTTPError(response.status, response.reason)
+        return response
+
+class DirectorySource(object):
+    '''Read files from a local directory in place of the GHCN server. Only the
+file name of each requested path is used, so the directory should contain
+ghcnd-inventory.txt and the station .dly files side by side. latency adds a
+simulated round trip delay, in seconds, to every request'''
+    def __init__(self, root, latency=0):
+        self.root = root
+        self.latency = latency
+
+    def get(self, path, offset=0, etag=None, modified=None):
+        if self.latency:
+            time.sleep(self.latency)
+        file_path = os.path.join(self.root, os.path.basename(path))
+        if not os.path.exists(file_path):
+            raise HTTPError(404, 'Not Found')
+        stat = os.stat(file_path)
+        file_etag = '"%x-%x"' % (int(stat.st_mtime), stat.st_size)
+        if etag == file_etag:
+            return None
+        if offset > stat.st_size:
+            offset = 0
+        with open(file_path, 'rb') as file:
+            file.seek(offset)
+            body = file.read()
+        return Resource(body, offset, stat.st_size, file_etag, email.utils.formatdate(stat.st_mtime, usegmt=True))
+
+    def open(self, path):
+        if self.latency:
+            time.sleep(self.latency)
+        file_path = os.path.join(self.root, os.path.basename(path))
+        if not os.path.exists(file_path):
+            raise HTTPError(404, 'Not Found')
+        return open(file_path, 'rb')
+
+def open_source (location=None):
+    '''Return a source for the given location, which may be the path of a local
+directory or the name of an HTTP host. Defaults to the NCDC server'''
+    if location is None:
+        return HttpSource(GHCN_HOST)
+    if os.path.isdir(location):
+        return DirectorySource(location)
+    return HttpSource(location)
+
+def fetch (source, path, retries=3, backoff=1.0, stream=False, **options):
+    '''Read path from source, retrying failed requests with exponential backoff.
+Client errors (4xx) are not retried. Any options are passed on to source.get.
+With stream=True, returns a file-like object from source.open instead, which
+the caller must close'''
+    attempt = 0
+    while True:
+        try:
+            if stream:
+                return source.open(path)
+            resource = source.get(path, **options)
+            if resource is not None:
+                metrics.count('bytes_downloaded', len(resource.body))
+            return resource
+        except (httplib.HTTPException, IOError), err:
+            if attempt >= retries or getattr(err, 'status', 500) < 500:
+                raise
+        delay = backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+        attempt += 1
+        logger.debug('retrying %s in %.1f seconds', path, delay)
+        time.sleep(delay)
+
+_DONE = object()
+
+def pool_map (handler, items, workers=8):
+    '''Call handler on each of items using a bounded pool of worker threads.
+Yields an (item, result, error) tuple for each item as it completes, where error
+is the exception handler raised for that item, if any. Results are consumed on
+the calling thread, so the caller can write them to a database without sharing
+its connection'''
+    tasks = Queue.Queue(workers * 2)
+    results = Queue.Queue(workers * 2)
+    def work ():
+        while True:
+            item = tasks.get()
+            if item is _DONE:
+                break
+            try:
+                results.put((item, handler(item), None))
+            except Exception, err:
+                results.put((item, None, err))
+        results.put(_DONE)
+    def feed ():
+        for item in items:
+            tasks.put(item)
+        for i in xrange(workers):
+            tasks.put(_DONE)
+    threads = [ threading.Thread(target=feed) ]
+    threads.extend(threading.Thread(target=work) for i in xrange(workers))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    running = workers
+    while running > 0:
+        result = results.get()
+        if result is _DONE:
+            running -= 1
+        else:
+            yield result
+
+def month_offset (text, month):
+    '''Return the position in the contents of a .dly file of the first row for
+the given month (in YYYYMM form) or any later month, or len(text) if there is none.
+Rows are ordered by month, so everything from this offset on is the file's tail'''
+    position = 0
+    while position < len(text):
+        if text[position+11:position+17] >= month:
+            return position
+        position = text.find('\n', position)
+        if position < 0:
+            break
+        position += 1
+    return len(text)
+
+def create_tables (db_conn):
+    '''Create the station and temperature tables and the temperature indexes, if
+they don't already exist'''
+    db_conn.execute('CREATE TABLE IF NOT EXISTS station (id VARCHAR(11) NOT NULL, x INT NOT NULL, y INT NOT NULL, PRIMARY KEY (id));')
+    db_conn.execute('''CREATE TABLE IF NOT EXISTS temperature (station VARCHAR(11) NOT NULL REFERENCES station(id), 
+                                                                tmin INT NOT NULL, 
+                                                                tmax INT NOT NULL, 
+                                                                date DATE NOT NULL,
+                                                                PRIMARY KEY (station,date));''')
+    for name, columns in _TEMPERATURE_INDEXES:
+        db_conn.execute('CREATE INDEX IF NOT EXISTS %s ON %s' % (name, columns))
+    db_conn.commit()
+
+def parse_inventory (lines):
+    '''Parse a list of rows of ghcnd-inventory.txt into a structured array of
+INVENTORY records, decoding the fixed-width columns of all rows at once'''
+    chars = numpy.array(lines, 'S%d' % _INVENTORY_LENGTH).view(numpy.uint8).reshape(len(lines), _INVENTORY_LENGTH)
+    def column (start, end):
+        return numpy.ascontiguousarray(chars[:, start:end]).view('S%d' % (end - start)).ravel()
+    inventory = numpy.empty(len(lines), INVENTORY)
+    inventory['id'] = numpy.char.strip(column(0, 11))
+    inventory['lat'] = column(12, 20).astype(numpy.float64)
+    inventory['lon'] = column(21, 30).astype(numpy.float64)
+    inventory['element'] = numpy.char.strip(column(31, 35))
+    inventory['first_year'] = dly.decode_integers(chars[:, 36:40])
+    inventory['last_year'] = dly.decode_integers(chars[:, 41:45])
+    return inventory
+
+def read_inventory (stream, chunk_size=1 << 20):
+    '''Read ghcnd-inventory.txt from a file-like stream chunk_size bytes at a
+time, yielding a structured array of INVENTORY records for the complete rows
+in each chunk, so the whole file is never held in memory'''
+    remainder = ''
+    while True:
+        data = stream.read(chunk_size)
+        metrics.count('bytes_downloaded', len(data))
+        text = remainder + data
+        if data:
+            end = text.rfind('\n') + 1
+            text, remainder = text[:end], text[end:]
+        lines = [ line for line in text.splitlines() if line.strip() ]
+        if len(lines) > 0:
+            yield parse_inventory(lines)
+        if not data:
+            break
+
+def web_mercator (lon, lat):
+    '''Project arrays of longitudes and latitudes, in degrees, to Web Mercator x
+and y, truncated to whole meters'''
+    x = 6378137.0 * lon * 0.017453292519943295
+    sin = numpy.sin(lat * 0.017453292519943295)
+    y = 3189068.5 * numpy.log((1.0 + sin) / (1.0 - sin))
+    return x.astype(numpy.int64), y.astype(numpy.int64)
+
+def load_stations (db_conn, source, year=None, chunk_size=1 << 20):
+    '''Stream the station inventory from source and upsert every US station that
+reported maximum temperatures in year (by default the current year) into the
+station table, a chunk of the inventory at a time. Existing stations are
+updated in place, so the inventory can be refreshed without rebuilding the
+database. Returns the number of stations loaded'''
+    if year is None:
+        year = datetime.datetime.now().year
+    db_cursor = db_conn.cursor()
+    count = 0
+    stream = fetch(source, INVENTORY_PATH, stream=True)
+    try:
+        for inventory in read_inventory(stream, chunk_size):
+            stations = inventory[numpy.char.startswith(inventory['id'], 'US') &
+                                 (inventory['element'] == 'TMAX') & (inventory['last_year'] == year)]
+            x, y = web_mercator(stations['lon'], stations['lat'])
+            db_cursor.executemany('REPLACE INTO station (id,x,y) VALUES (?, ?, ?)',
+                                  zip(stations['id'].tolist(), x.tolist(), y.tolist()))
+            db_conn.commit()
+            count += len(stations)
+    finally:
+        stream.close()
+    metrics.count('stations_upserted', count)
+    db_cursor.close()
+    logger.debug('loaded %s stations', count)
+    return count
+
+def create_watermark_table (db_conn):
+    '''Create the table recording, for each station, the date of its latest
+stored observation, the offset into its .dly file of that month's first row,
+and the validators returned when the file was last downloaded'''
+    db_conn.execute('''CREATE TABLE IF NOT EXISTS watermark (station VARCHAR(11) NOT NULL REFERENCES station(id),
+                                                            date DATE,
+                                                            offset INT NOT NULL DEFAULT 0,
+                                                            size INT,
+                                                            etag TEXT,
+                                                            modified TEXT,
+                                                            PRIMARY KEY (station));''')
+    db_conn.commit()
+
+def read_watermarks (db_conn):
+    '''Return a dictionary of (date, offset, size, etag, modified) tuples from the
+watermark table, keyed by station id'''
+    watermarks = {}
+    for row in db_conn.execute('SELECT station,date,offset,size,etag,modified FROM watermark'):
+        date = row[1] and datetime.datetime.strptime(row[1], '%Y-%m-%d').date()
+        watermarks[row[0]] = (date,) + tuple(row[2:])
+    return watermarks
+
+def store_temperatures (db_conn, source, station_ids, begin_date, end_date, workers=8, refresh=False, batch_size=1):
+    '''Download the daily data for each of the given stations from source and store
+their temperatures between begin_date and end_date in the temperature table.
+
+Ingest is incremental: each station's watermark records the date of its latest
+stored observation and the offset of that month's first row in its file. A
+range starting in or after the watermark's month downloads only the tail of
+the file from that row on. When the range starts after the watermark, only
+later observations are parsed, and unchanged files are skipped by a
+conditional request; a range that overlaps the watermark, like the nightly
+run's, is parsed from begin_date. Only a range starting before the
+watermark's month, such as a backfill of earlier years, downloads the whole
+file. Pass refresh=True to ignore the watermarks and reload the whole date
+range.
+
+Downloads and parsing run on a pool of worker threads, while all writes happen
+on the calling thread so the database connection is never contended. Each
+transaction covers batch_size stations. Returns the number of observations stored'''
+    watermarks = {} if refresh else read_watermarks(db_conn)
+    def load (station_id):
+        path = '%s/all/%s.dly' % (GHCN_PATH, station_id)
+        since = begin_date
+        options = {}
+        watermark = watermarks.get(station_id, (None,))[0]
+        if watermark is not None and (begin_date.year, begin_date.month) >= (watermark.year, watermark.month):
+            # The range is all in the tail of the file from the watermark's month
+            date, offset, size, etag, modified = watermarks[station_id]
+            options = { 'offset': offset }
+            if begin_date > watermark:
+                # Everything up to the watermark is stored, so read only what
+                # follows it, and nothing at all if the file hasn't changed
+                since = date + datetime.timedelta(1)
+                options.update(etag=etag, modified=modified)
+        with metrics.timer('fetch'):
+            resource = fetch(source, path, **options)
+            if resource is None:
+                return None
+            if resource.offset and (not resource.body.startswith(station_id) or
+                                    resource.body[11:17] != '%04d%02d' % (watermark.year, watermark.month)):
+                # The file has been rewritten, so the old offset no longer falls
+                # on the first row of the watermark's month
+                resource = fetch(source, path)
+        with metrics.timer('parse'):
+            records = dly.parse(station_id, resource.body, since, end_date)
+        date = watermark
+        if len(records) > 0:
+            # Records are in date order, so the last is the latest
+            last = records['date'][-1]
+            last = datetime.date(int(last[0:4]), int(last[5:7]), int(last[8:10]))
+            if date is None or last > date:
+                date = last
+        offset = resource.offset
+        if date is not None:
+            offset += month_offset(resource.body, '%04d%02d' % (date.year, date.month))
+        return records.tolist(), (station_id, date, offset, resource.size, resource.etag, resource.modified)
+    db_cursor = db_conn.cursor()
+    count = 0
+    batched = 0
+    skipped = 0
+    start = time.time()
+    for station_id, result, error in pool_map(load, station_ids, workers):
+        if error is not None:
+            if not isinstance(error, (httplib.HTTPException, IOError)):
+                raise error
+            logger.error('error loading data for station %s: %s', station_id, error)
+            continue
+        if result is None:
+            skipped += 1
+            continue
+        records, watermark = result
+        with metrics.timer('sqlite'):
+            db_cursor.executemany('REPLACE INTO temperature (station,date,tmin,tmax) VALUES (?, ?, ?, ?)', records)
+            db_cursor.execute('REPLACE INTO watermark (station,date,offset,size,etag,modified) VALUES (?, ?, ?, ?, ?, ?)', watermark)
+            count += len(records)
+            batched += 1
+            if batched >= batch_size:
+                db_conn.commit()
+                batched = 0
+        metrics.count('stations_loaded')
+    with metrics.timer('sqlite'):
+        db_conn.commit()
+    db_cursor.close()
+    metrics.count('stations_skipped', skipped)
+    metrics.count('rows_inserted', count)
+    elapsed = time.time() - start
+    logger.debug('skipped %s stations with no new data', skipped)
+    logger.info('stored %s observations in %.1f seconds (%.0f rows/sec)', count, elapsed, count / max(elapsed, 0.001))
+    return count
+
+_TEMPERATURE_INDEXES = [ ('temperature_station_index', 'temperature (station)'),
+                         ('temperature_date_index', 'temperature (date)') ]
+
+@contextlib.contextmanager
+def bulk_load (db_conn):
+    '''Prepare the database for a large load, such as a backfill of several years.
+Switches to write-ahead logging with relaxed syncing and a larger page cache, and
+drops the temperature table's secondary indexes so they are rebuilt once, when
+the load completes, instead of being maintained row by row'''
+    db_conn.execute('PRAGMA journal_mode=WAL')
+    db_conn.execute('PRAGMA synchronous=NORMAL')
+    db_conn.execute('PRAGMA cache_size=-262144')
+    db_conn.execute('PRAGMA temp_store=MEMORY')
+    for name, columns in _TEMPERATURE_INDEXES:
+        db_conn.execute('DROP INDEX IF EXISTS %s' % name)
+    db_conn.commit()
+    try:
+        yield db_conn
+    finally:
+        start = time.time()
+        with metrics.timer('rebuild_indexes'):
+            for name, columns in _TEMPERATURE_INDEXES:
+                db_conn.execute('CREATE INDEX IF NOT EXISTS %s ON %s' % (name, columns))
+            db_conn.commit()
+        logger.debug('rebuilt temperature indexes in %.1f seconds', time.time() - start)
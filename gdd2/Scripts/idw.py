@@ -0,0 +1,376 @@
+'''Inverse distance weighted (IDW) interpolation of station values onto a regular
+grid with NumPy. Equivalent to arcpy.sa.Idw with a variable search radius: each
+cell takes the weighted mean of its k nearest stations within a maximum
+distance, and cells with no station in range are left as nodata.
+
+The neighbor search depends only on station locations, so it is done once and
+its weights applied to every field being interpolated. Work proceeds in bands
+of raster rows, so memory use is bounded by the band size, not the grid size.'''
+import hashlib, logging, numpy, os, shutil
+from numpy.lib.format import open_memmap
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+NODATA = -9999.0
+# Times to try building a cache entry that other processes keep evicting
+_CACHE_ATTEMPTS = 3
+logger = logging.getLogger('gdd.idw')
+
+class Grid(object):
+    '''A regular grid of square cells covering the extent (xmin, ymin, xmax,
+ymax). Rows run north to south, as in a raster'''
+    def __init__(self, extent, cell_size):
+        self.xmin, self.ymin, self.xmax, self.ymax = [ float(value) for value in extent ]
+        self.cell_size = float(cell_size)
+        self.cols = int(round((self.xmax - self.xmin) / self.cell_size))
+        self.rows = int(round((self.ymax - self.ymin) / self.cell_size))
+
+    @property
+    def shape(self):
+        return (self.rows, self.cols)
+
+    def centers(self, row0, row1, col0=0, col1=None):
+        '''Return an (n, 2) array of the centers of the cells in the given block of
+rows and columns, in row-major order'''
+        if col1 is None:
+            col1 = self.cols
+        x = self.xmin + (numpy.arange(col0, col1) + 0.5) * self.cell_size
+        y = self.ymax - (numpy.arange(row0, row1) + 0.5) * self.cell_size
+        xx, yy = numpy.meshgrid(x, y)
+        return numpy.column_stack((xx.ravel(), yy.ravel()))
+
+class NeighborIndex(object):
+    '''Spatial index over a set of points, answering k-nearest-neighbor queries
+within a maximum radius. Uses scipy's KD-tree when it is available, and
+otherwise a sort on x that narrows each query to the points within range of
+the query block before a brute-force search'''
+    def __init__(self, xy):
+        self.xy = numpy.asarray(xy, numpy.float64).reshape(-1, 2)
+        if cKDTree is not None:
+            self._tree = cKDTree(self.xy)
+        else:
+            self._tree = None
+            self._order = numpy.argsort(self.xy[:, 0], kind='mergesort')
+            self._x = self.xy[self._order, 0]
+
+    def __len__(self):
+        return len(self.xy)
+
+    def query(self, points, k, radius):
+        '''Return (distances, indices) arrays of shape (len(points), k) holding the k
+nearest points to each of points that lie within radius, nearest first. Where
+there are fewer than k, the remaining distances are infinite and the remaining
+indices are len(self)'''
+        points = numpy.asarray(points, numpy.float64).reshape(-1, 2)
+        if self._tree is not None:
+            distances, indices = self._tree.query(points, k, distance_upper_bound=radius)
+            return distances.reshape(len(points), k), indices.reshape(len(points), k)
+        distances = numpy.empty((len(points), k))
+        distances.fill(numpy.inf)
+        indices = numpy.empty((len(points), k), numpy.intp)
+        indices.fill(len(self.xy))
+        if len(points) == 0:
+            return distances, indices
+        lo = numpy.searchsorted(self._x, points[:, 0].min() - radius, 'left')
+        hi = numpy.searchsorted(self._x, points[:, 0].max() + radius, 'right')
+        candidates = self._order[lo:hi]
+        cy = self.xy[candidates, 1]
+        candidates = candidates[(cy >= points[:, 1].min() - radius) & (cy <= points[:, 1].max() + radius)]
+        if len(candidates) == 0:
+            return distances, indices
+        dx = points[:, 0, numpy.newaxis] - self.xy[candidates, 0]
+        dy = points[:, 1, numpy.newaxis] - self.xy[candidates, 1]
+        d = numpy.sqrt(dx * dx + dy * dy)
+        count = min(k, len(candidates))
+        nearest = numpy.argsort(d, axis=1)[:, :count]
+        rows = numpy.arange(len(points))[:, numpy.newaxis]
+        distances[:, :count] = d[rows, nearest]
+        indices[:, :count] = candidates[nearest]
+        out_of_range = distances > radius
+        distances[out_of_range] = numpy.inf
+        indices[out_of_range] = len(self.xy)
+        return distances, indices
+
+def idw_weights (distances, power=2):
+    '''Return normalized inverse distance weights for an (n, k) array of neighbor
+distances. Infinite distances get zero weight, a cell that coincides with a
+station takes that station's value, and a cell with no neighbors gets all-zero
+weights'''
+    weights = 1.0 / numpy.maximum(distances, 1e-6) ** power
+    total = weights.sum(axis=1)
+    total[total == 0] = 1.0
+    return weights / total[:, numpy.newaxis]
+
+class Interpolator(object):
+    '''Interpolates values measured at the points xy onto grid, using the k
+nearest points within radius of each cell, weighted by inverse distance raised
+to power'''
+    def __init__(self, grid, xy, k=10, power=2, radius=300000, chunk_rows=64):
+        self.grid = grid
+        self.index = NeighborIndex(xy)
+        self.k = k
+        self.power = power
+        self.radius = radius
+        self.chunk_rows = chunk_rows
+        # The order in which interpolate reads the points' values
+        self.order = None
+
+    def search(self, row0, row1):
+        '''Return (indices, distances) arrays of shape (cells, k) holding the nearest
+points to the cells of rows row0 to row1, in row-major order. Each block of
+cells is searched separately so the brute-force search only considers points
+near it'''
+        grid = self.grid
+        indices = numpy.empty((row1 - row0, grid.cols, self.k), numpy.intp)
+        distances = numpy.empty((row1 - row0, grid.cols, self.k))
+        for col0 in xrange(0, grid.cols, self.chunk_rows):
+            col1 = min(col0 + self.chunk_rows, grid.cols)
+            block_distances, block_indices = self.index.query(grid.centers(row0, row1, col0, col1), self.k, self.radius)
+            indices[:, col0:col1] = block_indices.reshape(row1 - row0, col1 - col0, self.k)
+            distances[:, col0:col1] = block_distances.reshape(row1 - row0, col1 - col0, self.k)
+        return indices.reshape(-1, self.k), distances.reshape(-1, self.k)
+
+    def neighbors(self, row0, row1):
+        '''Return (indices, weights) arrays of shape (cells, k) for the cells of rows
+row0 to row1, in row-major order'''
+        indices, distances = self.search(row0, row1)
+        return indices, idw_weights(distances, self.power)
+
+    def bands(self):
+        '''Yield (row0, row1, indices, weights) for each band of rows in the grid'''
+        for row0 in xrange(0, self.grid.rows, self.chunk_rows):
+            row1 = min(row0 + self.chunk_rows, self.grid.rows)
+            indices, weights = self.neighbors(row0, row1)
+            yield row0, row1, indices, weights
+
+    def interpolate(self, values, nodata=NODATA):
+        '''Interpolate one or more fields. values is a dictionary mapping field names
+to arrays of values at each point; returns a dictionary mapping the same names
+to float32 arrays of the grid's shape, with nodata where no point is in range'''
+        padded = {}
+        for name, field in values.iteritems():
+            field = numpy.asarray(field, numpy.float64)
+            if self.order is not None:
+                field = field[self.order]
+            # A trailing zero gives the missing-neighbor index a harmless value
+            padded[name] = numpy.append(field, 0.0)
+        results = {}
+        for name in values:
+            results[name] = numpy.empty(self.grid.shape, numpy.float32)
+        for row0, row1, indices, weights in self.bands():
+            empty = (weights.sum(axis=1) == 0).reshape(row1 - row0, self.grid.cols)
+            for name, field in padded.iteritems():
+                band = (field[indices] * weights).sum(axis=1).reshape(row1 - row0, self.grid.cols)
+                band[empty] = nodata
+                results[name][row0:row1] = band
+        return results
+
+class InterpolatorFactory(object):
+    '''Creates a new Interpolator for each set of stations. Can be used in place of a
+WeightCache, and like one can be passed to other processes'''
+    def __init__(self, grid, k=10, power=2, radius=300000, chunk_rows=64):
+        self.grid = grid
+        self.k = k
+        self.power = power
+        self.radius = radius
+        self.chunk_rows = chunk_rows
+
+    def interpolator(self, ids, xy):
+        return Interpolator(self.grid, xy, self.k, self.power, self.radius, self.chunk_rows)
+
+class CachedInterpolator(Interpolator):
+    '''An Interpolator whose neighbor search has been done in advance and saved
+by a WeightCache. Interpolating is then just a weighted sum over the saved
+neighbors of each cell, a sparse matrix-vector product'''
+    def __init__(self, grid, xy, indices, distances, order, k=10, power=2, radius=300000, chunk_rows=64):
+        Interpolator.__init__(self, grid, xy, k, power, radius, chunk_rows)
+        self.indices = indices
+        self.distances = distances
+        self.order = order
+
+    def search(self, row0, row1):
+        cols = self.grid.cols
+        return (numpy.asarray(self.indices[row0 * cols:row1 * cols], numpy.intp),
+                numpy.asarray(self.distances[row0 * cols:row1 * cols], numpy.float64))
+
+class WeightCache(object):
+    '''An on-disk cache of the neighbor search for grid, keyed by a hash of the set
+of stations searched. The weights depend only on where the stations are, not
+on what they measured, and most days have nearly the same stations, so a day
+whose station set has been seen before needs no search at all. A day whose set
+differs from a cached one by no more than max_patch of its stations is patched
+from it, searching again only the cells whose neighbors were removed or that
+are closer to an added station than to their farthest neighbor.
+
+Each entry is a directory of .npy files holding the nearest station indices
+and distances for every cell, memory mapped when used. At most max_entries are
+kept, discarding the least recently used. Several processes may share a cache;
+a process that finds an entry it needs evicted by another builds it again'''
+    def __init__(self, folder, grid, k=10, power=2, radius=300000, chunk_rows=64, max_entries=8, max_patch=0.05):
+        self.folder = folder
+        self.grid = grid
+        self.k = k
+        self.power = power
+        self.radius = radius
+        self.chunk_rows = chunk_rows
+        self.max_entries = max_entries
+        self.max_patch = max_patch
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def key(self, ids, xy):
+        '''Return the cache key for the given sorted station ids and locations'''
+        grid = self.grid
+        digest = hashlib.sha1(repr((grid.xmin, grid.ymin, grid.xmax, grid.ymax, grid.cell_size,
+                                    self.k, self.radius)))
+        digest.update(numpy.ascontiguousarray(ids).tostring())
+        digest.update(numpy.ascontiguousarray(xy, numpy.float64).tostring())
+        return digest.hexdigest()
+
+    def interpolator(self, ids, xy):
+        '''Return an interpolator for stations with the given ids and locations,
+loading its neighbor search from the cache, patching it from a similar cached
+station set, or searching from scratch and caching the result'''
+        ids = numpy.asarray(ids, 'S11')
+        order = numpy.argsort(ids, kind='mergesort')
+        ids = ids[order]
+        xy = numpy.asarray(xy, numpy.float64).reshape(-1, 2)[order]
+        key = self.key(ids, xy)
+        path = os.path.join(self.folder, key)
+        for attempt in xrange(_CACHE_ATTEMPTS):
+            if not os.path.exists(path):
+                self._store(path, ids, xy)
+            try:
+                os.utime(os.path.join(path, 'ids.npy'), None)
+                return CachedInterpolator(self.grid, xy,
+                                          numpy.load(os.path.join(path, 'indices.npy'), mmap_mode='r'),
+                                          numpy.load(os.path.join(path, 'distances.npy'), mmap_mode='r'),
+                                          order, self.k, self.power, self.radius, self.chunk_rows)
+            except (IOError, OSError), err:
+                # Another process evicted the entry between storing and loading it
+                logger.debug('cache entry %s went missing (%s), building it again', key, err)
+                shutil.rmtree(path, ignore_errors=True)
+        logger.warning('cache entry %s keeps being evicted, searching neighbors without the cache', key)
+        interpolator = Interpolator(self.grid, xy, self.k, self.power, self.radius, self.chunk_rows)
+        interpolator.order = order
+        return interpolator
+
+    def _store(self, path, ids, xy):
+        '''Search or patch the neighbors for the given sorted stations into a new
+cache entry at path'''
+        temp_path = '%s.%s.tmp' % (path, os.getpid())
+        if os.path.exists(temp_path):
+            shutil.rmtree(temp_path)
+        os.makedirs(temp_path)
+        base = self._similar(ids, xy)
+        built = False
+        if base is not None:
+            logger.debug('patching neighbors for %s stations from cache entry %s', len(ids), os.path.basename(base))
+            try:
+                self._patch(temp_path, ids, xy, base)
+                built = True
+            except (IOError, OSError), err:
+                # Another process evicted the base entry while it was being read
+                logger.debug('cache entry %s went missing (%s), searching from scratch', os.path.basename(base), err)
+        if not built:
+            logger.debug('searching neighbors for %s stations', len(ids))
+            self._build(temp_path, ids, xy)
+        numpy.save(os.path.join(temp_path, 'xy.npy'), xy)
+        numpy.save(os.path.join(temp_path, 'ids.npy'), ids)
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            # Another process got there first
+            if not os.path.exists(path):
+                raise
+            shutil.rmtree(temp_path, ignore_errors=True)
+        self._evict(path)
+
+    def _entries(self):
+        # Skip entries still being written, or left behind by a process that died
+        return [ os.path.join(self.folder, name) for name in os.listdir(self.folder)
+                 if not name.endswith('.tmp') and os.path.exists(os.path.join(self.folder, name, 'ids.npy')) ]
+
+    @staticmethod
+    def _match(ids, xy, other_ids, other_xy):
+        '''Return the index in the sorted other_ids of each of the stations ids, or
+-1 where a station is missing from the other set or has moved'''
+        if len(other_ids) == 0:
+            return numpy.empty(len(ids), numpy.intp) - 1
+        position = numpy.minimum(numpy.searchsorted(other_ids, ids), len(other_ids) - 1)
+        same = (other_ids[position] == ids) & (other_xy[position] == xy).all(axis=1)
+        return numpy.where(same, position, -1)
+
+    def _similar(self, ids, xy):
+        '''Return the cached entry whose station set differs least from ids and
+their locations xy, if it differs by few enough stations to be worth patching.
+A station that has moved counts as removed and added'''
+        best, best_difference = None, int(self.max_patch * len(ids))
+        for path in self._entries():
+            try:
+                cached_ids = numpy.load(os.path.join(path, 'ids.npy'))
+                cached_xy = numpy.load(os.path.join(path, 'xy.npy'))
+            except (IOError, OSError):
+                # Evicted by another process since it was listed
+                continue
+            common = (self._match(ids, xy, cached_ids, cached_xy) >= 0).sum()
+            difference = (len(ids) - common) + (len(cached_ids) - common)
+            if difference <= best_difference:
+                best, best_difference = path, difference
+        return best
+
+    def _create(self, path):
+        cells = self.grid.rows * self.grid.cols
+        return (open_memmap(os.path.join(path, 'indices.npy'), 'w+', numpy.int32, (cells, self.k)),
+                open_memmap(os.path.join(path, 'distances.npy'), 'w+', numpy.float32, (cells, self.k)))
+
+    def _build(self, path, ids, xy):
+        interpolator = Interpolator(self.grid, xy, self.k, self.power, self.radius, self.chunk_rows)
+        indices, distances = self._create(path)
+        cols = self.grid.cols
+        for row0 in xrange(0, self.grid.rows, self.chunk_rows):
+            row1 = min(row0 + self.chunk_rows, self.grid.rows)
+            indices[row0 * cols:row1 * cols], distances[row0 * cols:row1 * cols] = interpolator.search(row0, row1)
+        del indices, distances
+
+    def _patch(self, path, ids, xy, base):
+        old_ids = numpy.load(os.path.join(base, 'ids.npy'))
+        old_xy = numpy.load(os.path.join(base, 'xy.npy'))
+        old_indices = numpy.load(os.path.join(base, 'indices.npy'), mmap_mode='r')
+        old_distances = numpy.load(os.path.join(base, 'distances.npy'), mmap_mode='r')
+        # Map each old station index, and the old missing-neighbor index, to its
+        # index in the new set, or -1 if the station has been removed or moved
+        remap = self._match(old_ids, old_xy, ids, xy)
+        added = numpy.ones(len(ids), bool)
+        added[remap[remap >= 0]] = False
+        remap = numpy.append(remap, len(ids))
+        added_index = NeighborIndex(xy[added]) if added.any() else None
+        index = NeighborIndex(xy)
+        indices, distances = self._create(path)
+        cols = self.grid.cols
+        patched = 0
+        for row0 in xrange(0, self.grid.rows, self.chunk_rows):
+            row1 = min(row0 + self.chunk_rows, self.grid.rows)
+            band_indices = remap[old_indices[row0 * cols:row1 * cols]]
+            band_distances = numpy.array(old_distances[row0 * cols:row1 * cols], numpy.float64)
+            stale = (band_indices < 0).any(axis=1)
+            centers = self.grid.centers(row0, row1)
+            if added_index is not None:
+                nearest_added = added_index.query(centers, 1, self.radius)[0][:, 0]
+                stale |= nearest_added < band_distances[:, -1]
+            if stale.any():
+                band_distances[stale], band_indices[stale] = index.query(centers[stale], self.k, self.radius)
+                patched += stale.sum()
+            indices[row0 * cols:row1 * cols] = band_indices
+            distances[row0 * cols:row1 * cols] = band_distances
+        del indices, distances
+        logger.debug('searched %s of %s cells again', patched, self.grid.rows * cols)
+
+    def _evict(self, keep):
+        entries = sorted(self._entries(), key=lambda path: os.path.getmtime(os.path.join(path, 'ids.npy')), reverse=True)
+        for path in entries[self.max_entries:]:
+            if path != keep:
+                shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,106 @@
+'''Instrumentation for a run of the gdd pipeline: how long each stage took and
+counts of the work it did, written out as one JSON line per run so slow nightly
+runs can be traced to downloading, parsing, SQLite, interpolation, raster
+copies or mosaic maintenance.
+
+Stages are timed with the timer context manager and work is counted with
+count; both record into the current run, which reset starts afresh. Timings
+sum over every call, including calls from worker threads, so a stage run on
+several threads at once can report more time than the run took. One stage can
+also be profiled with cProfile, when it runs on the main thread.'''
+import contextlib, cProfile, datetime, functools, json, logging, os, threading, time
+
+logger = logging.getLogger('gdd.metrics')
+
+class Metrics(object):
+    '''Timings and counters for one run. If profile names a stage, every call of
+that stage is profiled, and the combined profile written by write_profile'''
+    def __init__(self, profile=None):
+        self.started = time.time()
+        self.timings = {}
+        self.counters = {}
+        self.profile = profile
+        self._profiler = None
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def timer (self, stage):
+        profiler = None
+        if stage == self.profile and threading.current_thread().name == 'MainThread':
+            if self._profiler is None:
+                self._profiler = cProfile.Profile()
+            profiler = self._profiler
+            profiler.enable()
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            if profiler is not None:
+                profiler.disable()
+            with self._lock:
+                total, calls = self.timings.get(stage, (0.0, 0))
+                self.timings[stage] = (total + elapsed, calls + 1)
+
+    def count (self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report (self, **fields):
+        '''Return the run's timings and counters as a dictionary, with any extra
+fields given'''
+        report = { 'started': datetime.datetime.fromtimestamp(self.started).isoformat(),
+                   'elapsed': round(time.time() - self.started, 3),
+                   'timings': dict((stage, { 'seconds': round(total, 3), 'calls': calls })
+                                   for stage, (total, calls) in self.timings.items()),
+                   'counters': dict(self.counters) }
+        report.update(fields)
+        return report
+
+    def write (self, path, **fields):
+        '''Append the run's report to the JSON lines file at path'''
+        report = self.report(**fields)
+        with open(path, 'a') as file:
+            file.write(json.dumps(report, sort_keys=True) + '\n')
+        logger.info('run took %.1f seconds: %s', report['elapsed'],
+                    ', '.join('%s %.1fs' % (stage, timing['seconds'])
+                              for stage, timing in sorted(report['timings'].items())))
+        return report
+
+    def write_profile (self, path):
+        '''Write the profile of the profiled stage to path, for use with pstats,
+if it ran'''
+        if self._profiler is not None:
+            self._profiler.dump_stats(path)
+            logger.debug('wrote profile of %s to %s', self.profile, path)
+            return True
+        return False
+
+_CURRENT = Metrics()
+
+def reset (profile=None):
+    '''Start recording a new run, profiling the named stage if profile is given'''
+    global _CURRENT
+    _CURRENT = Metrics(profile)
+    return _CURRENT
+
+def current ():
+    return _CURRENT
+
+def timer (stage):
+    '''Time a stage of the current run: with metrics.timer('stage'): ...'''
+    return _CURRENT.timer(stage)
+
+def count (name, value=1):
+    '''Add value to one of the current run's counters'''
+    _CURRENT.count(name, value)
+
+def timed (stage):
+    '''Decorate a function so that each call to it is timed as the given stage'''
+    def decorate (function):
+        @functools.wraps(function)
+        def wrapper (*args, **kwargs):
+            with timer(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
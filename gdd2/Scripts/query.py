@@ -0,0 +1,213 @@
+'''Point and time series queries over growing degree day output, for questions
+like "cumulative growing degree days at this latitude and longitude for every
+day this season".
+
+Longitudes and latitudes are projected to the Web Mercator grid the rasters
+are computed on, and values are read a block of cells at a time, either from
+the chunks of the time series archive (archive.py) or from windows of the daily
+GDD_%Y%m%d rasters in the results geodatabase. Decoded blocks are kept in a
+size-bounded least recently used cache, so repeated and neighboring queries
+are answered from memory, and batch queries read each block once however many
+points fall in it.'''
+import archive, csv, datetime, idw, logging, math, numpy, optparse, sys, threading
+
+EARTH_RADIUS = 6378137.0
+MAX_LATITUDE = 85.0511287798
+NODATA = 65535
+logger = logging.getLogger('gdd.query')
+
+def to_web_mercator (lon, lat):
+    '''Project arrays of WGS84 longitudes and latitudes, in degrees, to Web
+Mercator x and y, in meters'''
+    lon = numpy.radians(numpy.asarray(lon, numpy.float64))
+    lat = numpy.radians(numpy.clip(numpy.asarray(lat, numpy.float64), -MAX_LATITUDE, MAX_LATITUDE))
+    return EARTH_RADIUS * lon, EARTH_RADIUS * numpy.log(numpy.tan(math.pi / 4 + lat / 2))
+
+def to_cells (grid, lon, lat):
+    '''Return arrays of the rows and columns of grid holding the given longitudes
+and latitudes, with -1 for points outside the grid'''
+    x, y = to_web_mercator(lon, lat)
+    rows = numpy.floor((grid.ymax - y) / grid.cell_size).astype(numpy.int64)
+    cols = numpy.floor((x - grid.xmin) / grid.cell_size).astype(numpy.int64)
+    outside = (rows < 0) | (rows >= grid.rows) | (cols < 0) | (cols >= grid.cols)
+    rows[outside] = -1
+    cols[outside] = -1
+    return rows, cols
+
+class BlockCache(object):
+    '''A least recently used cache of arrays, bounded by their total size in bytes'''
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._tick = 0
+        self._lock = threading.Lock()
+
+    def get (self, key, load):
+        '''Return the array cached for key, calling load() to read it on a miss'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                self._tick += 1
+                entry[1] = self._tick
+                return entry[0]
+            self.misses += 1
+        value = load()
+        if value is None:
+            return None
+        with self._lock:
+            if key not in self._entries:
+                self._tick += 1
+                self._entries[key] = [ value, self._tick ]
+                self.size += value.nbytes
+                self._evict()
+        return value
+
+    def _evict (self):
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            key = min(self._entries, key=lambda key: self._entries[key][1])
+            self.size -= self._entries.pop(key)[0].nbytes
+
+    def clear (self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+class ArchiveBlocks(object):
+    '''Blocks read from the full resolution chunks of a time series archive'''
+    def __init__(self, path):
+        self.archive = archive.Archive(path)
+        self.grid = idw.Grid(self.archive.extent, self.archive.cell_size)
+        self.block_shape = self.archive.levels[0].chunks
+
+    def time_index (self, date):
+        return (date - self.archive.origin).days
+
+    def block (self, index):
+        '''Return the (days, rows, cols) block with the given block index, or None
+if it is past the end of the archive'''
+        array = self.archive.levels[0]
+        if index[0] < 0 or index[0] * array.chunks[0] >= array.shape[0]:
+            return None
+        return numpy.array(array.read_chunk(index))
+
+class RasterBlocks(object):
+    '''Blocks read as windows of the daily GDD_%Y%m%d rasters in a geodatabase,
+one day per block. Needs arcpy'''
+    def __init__(self, workspace, grid, block_size=256):
+        self.workspace = workspace
+        self.grid = grid
+        self.block_shape = (1, block_size, block_size)
+
+    def time_index (self, date):
+        return date.toordinal()
+
+    def block (self, index):
+        '''Return the (1, rows, cols) block with the given block index, or None if
+there is no raster for its date'''
+        import arcpy, os
+        raster = os.path.join(self.workspace, datetime.date.fromordinal(index[0]).strftime('GDD_%Y%m%d'))
+        if not arcpy.Exists(raster):
+            return None
+        days, rows, cols = self.block_shape
+        row0, col0 = index[1] * rows, index[2] * cols
+        nrows, ncols = min(rows, self.grid.rows - row0), min(cols, self.grid.cols - col0)
+        corner = arcpy.Point(self.grid.xmin + col0 * self.grid.cell_size,
+                             self.grid.ymax - (row0 + nrows) * self.grid.cell_size)
+        block = numpy.empty(self.block_shape, numpy.uint16)
+        block.fill(NODATA)
+        block[0, :nrows, :ncols] = arcpy.RasterToNumPyArray(raster, corner, ncols, nrows, NODATA)
+        return block
+
+class Query(object):
+    '''Point and time series queries against a block source: an ArchiveBlocks or
+a RasterBlocks'''
+    def __init__(self, source, cache=None):
+        self.source = source
+        self.cache = cache if cache is not None else BlockCache()
+
+    def _block (self, index):
+        return self.cache.get(index, lambda: self.source.block(index))
+
+    def batch (self, lon, lat, begin_date, end_date=None):
+        '''Return a (points, days) float64 array of cumulative growing degree days
+for each of the given longitudes and latitudes and each date from begin_date to
+end_date inclusive (just begin_date by default), with NaN where there is no
+data. Each block is read once, for all of the points that fall in it'''
+        if end_date is None:
+            end_date = begin_date
+        rows, cols = to_cells(self.source.grid, numpy.atleast_1d(lon), numpy.atleast_1d(lat))
+        t0 = self.source.time_index(begin_date)
+        t1 = self.source.time_index(end_date) + 1
+        result = numpy.empty((len(rows), max(t1 - t0, 0)))
+        result.fill(numpy.nan)
+        block_days, block_rows, block_cols = self.source.block_shape
+        inside = numpy.nonzero(rows >= 0)[0]
+        if len(inside) == 0:
+            return result
+        # Group the points by the block of cells they fall in
+        keys = (rows[inside] // block_rows) * (self.source.grid.cols // block_cols + 1) + cols[inside] // block_cols
+        order = numpy.argsort(keys, kind='mergesort')
+        inside, keys = inside[order], keys[order]
+        starts = numpy.concatenate(([ 0 ], numpy.nonzero(numpy.diff(keys))[0] + 1, [ len(keys) ]))
+        for start, stop in zip(starts[:-1], starts[1:]):
+            points = inside[start:stop]
+            brow, bcol = int(rows[points[0]] // block_rows), int(cols[points[0]] // block_cols)
+            r, c = rows[points] % block_rows, cols[points] % block_cols
+            for tblock in xrange(t0 // block_days, (t1 - 1) // block_days + 1):
+                block = self._block((tblock, brow, bcol))
+                if block is None:
+                    continue
+                b0, b1 = max(t0, tblock * block_days), min(t1, (tblock + 1) * block_days)
+                values = block[b0 - tblock * block_days:b1 - tblock * block_days][:, r, c].T
+                result[points, b0 - t0:b1 - t0] = numpy.where(values == NODATA, numpy.nan, values)
+        return result
+
+    def series (self, lon, lat, begin_date, end_date):
+        '''Return a list of (date, value) pairs for one point and each date from
+begin_date to end_date, with None for values where there is no data'''
+        values = self.batch([ lon ], [ lat ], begin_date, end_date)[0]
+        return [ (begin_date + datetime.timedelta(index), None if numpy.isnan(value) else float(value))
+                 for index, value in enumerate(values) ]
+
+    def value (self, lon, lat, date):
+        '''Return the cumulative growing degree days at one point on one date, or None'''
+        return self.series(lon, lat, date, date)[0][1]
+
+def main (argv=None):
+    '''Usage: <script> [--rasters] <archive_or_workspace> <begin_date> <end_date(optional)>
+read "longitude,latitude" lines from standard input and write a CSV of the
+cumulative growing degree days at each point for each date from begin_date to
+end_date, inclusive, to standard output. Reads from the time series archive at
+the given path, or with --rasters from the daily rasters in the given
+geodatabase.'''
+    parser = optparse.OptionParser(usage=main.__doc__)
+    parser.add_option('-r', '--rasters', action='store_true', default=False,
+                      help='read the daily rasters in a geodatabase instead of an archive')
+    options, args = parser.parse_args(argv or [])
+    if len(args) < 2:
+        parser.error('a source and a begin date are required')
+    begin_date = datetime.datetime.strptime(args[1], '%Y-%m-%d').date()
+    end_date = begin_date
+    if len(args) > 2:
+        end_date = datetime.datetime.strptime(args[2], '%Y-%m-%d').date()
+    if options.rasters:
+        import gdd
+        source = RasterBlocks(args[0], gdd._GRID)
+    else:
+        source = ArchiveBlocks(args[0])
+    points = numpy.array([ [ float(value) for value in row[:2] ] for row in csv.reader(sys.stdin) if row ]).reshape(-1, 2)
+    values = Query(source).batch(points[:, 0], points[:, 1], begin_date, end_date)
+    writer = csv.writer(sys.stdout)
+    writer.writerow([ 'longitude', 'latitude' ] + [ (begin_date + datetime.timedelta(index)).isoformat()
+                                                    for index in xrange(values.shape[1]) ])
+    for point, row in zip(points, values):
+        writer.writerow(list(point) + [ '' if numpy.isnan(value) else int(value) for value in row ])
+    return 0
+
+if __name__ == "__main__":
+    status = main(sys.argv[1:])
+    sys.exit(status)
@@ -0,0 +1,101 @@
+'''Growing degree days computed for a whole range of dates in one batch. All of
+the range's observations are read with a single query, each day is interpolated
+into one layer of a (days, rows, cols) stack, and the cumulative totals are
+then formed with a running sum down the stack that restarts on January 1st,
+rounded to whole degree days each day. The stack is a memory-mapped file, so
+long ranges don't have to fit in memory.
+
+Each day's interpolation is independent of the others; only the running sum
+links one day to the next. So the days can be interpolated in parallel on a
+pool of processes, each writing its layer straight into the shared stack, with
+the running sum done once they have all finished.'''
+import datetime, itertools, logging, multiprocessing, numpy, os
+from numpy.lib.format import open_memmap
+
+logger = logging.getLogger('gdd.series')
+
+def observations (db_conn, begin_date, end_date):
+    '''Read the observations for every date from begin_date to end_date with one
+query, yielding a (date, ids, xy, tmax, tmin) tuple of arrays for each date that
+has any'''
+    db_cursor = db_conn.cursor()
+    db_cursor.execute('''SELECT t.date,s.id,s.x,s.y,t.tmax,t.tmin FROM temperature t INNER JOIN station s ON s.id=t.station
+                         WHERE t.date BETWEEN ? AND ? ORDER BY t.date''', (begin_date, end_date))
+    for date, rows in itertools.groupby(db_cursor, lambda row: row[0]):
+        rows = list(rows)
+        ids = numpy.array([ row[1] for row in rows ], 'S11')
+        records = numpy.array([ row[2:] for row in rows ], numpy.float64).reshape(-1, 4)
+        yield (datetime.datetime.strptime(date, '%Y-%m-%d').date(), ids,
+               records[:, 0:2], records[:, 2], records[:, 3])
+    db_cursor.close()
+
+def daily_gdd (tmax, tmin, min_temp, max_temp):
+    '''Return the growing degree days for a single day from arrays of maximum and
+minimum temperatures: the mean temperature above min_temp, capped at max_temp'''
+    return numpy.clip((tmax + tmin) / 2.0 - min_temp, 0, max_temp - min_temp)
+
+def accumulate (stack, dates, previous=None, chunk_rows=64):
+    '''Turn a (days, rows, cols) stack of daily growing degree days for the
+consecutive dates into cumulative totals, in place. Totals restart on January
+1st; previous holds the totals for the day before dates[0], if any. NaN cells
+stay NaN from the day they appear. Each day's total is rounded to a whole
+degree day before the next day is added to it, as it is when the day-by-day
+path stores it in a 16-bit raster, so both paths give the same totals'''
+    for row0 in xrange(0, stack.shape[1], chunk_rows):
+        row1 = min(row0 + chunk_rows, stack.shape[1])
+        totals = numpy.zeros(stack[0, row0:row1].shape, stack.dtype)
+        if previous is not None and (dates[0].month != 1 or dates[0].day != 1):
+            totals += previous[row0:row1]
+        for index, date in enumerate(dates):
+            if index > 0 and date.month == 1 and date.day == 1:
+                totals.fill(0)
+            totals = numpy.floor(totals + stack[index, row0:row1] + 0.5)
+            stack[index, row0:row1] = totals
+    return stack
+
+def _interpolate_day (task):
+    '''Interpolate one day's observations and write its growing degree days into
+its layer of the stack at path. Runs in a worker process when computing in
+parallel, so takes all of its arguments as a single picklable tuple'''
+    path, index, weights, ids, xy, tmax, tmin, min_temp, max_temp = task
+    grids = weights.interpolator(ids, xy).interpolate({ 'tmax': tmax, 'tmin': tmin }, numpy.nan)
+    stack = numpy.load(path, mmap_mode='r+')
+    stack[index] = daily_gdd(grids['tmax'], grids['tmin'], min_temp, max_temp)
+    stack.flush()
+    del stack
+    return index
+
+def compute (db_conn, begin_date, end_date, grid, min_temp, max_temp, weights, path, previous=None, processes=1):
+    '''Compute cumulative growing degree days for each date from begin_date to
+end_date into a float32 (days, rows, cols) array memory mapped from the file at
+path, returning the array and the list of its dates. weights.interpolator(ids, xy)
+must return an idw.Interpolator for the given stations; pass an idw.WeightCache or
+idw.InterpolatorFactory. With processes greater than one, days are interpolated in
+parallel on a pool of that many worker processes. Days with no observations end
+the range early, since the totals after them can't be computed'''
+    days = (end_date - begin_date).days + 1
+    stack = open_memmap(path, 'w+', numpy.float32, (days,) + grid.shape)
+    stack.flush()
+    tasks = []
+    for date, ids, xy, tmax, tmin in observations(db_conn, begin_date, end_date):
+        if date != begin_date + datetime.timedelta(len(tasks)):
+            break
+        tasks.append((path, len(tasks), weights, ids, xy, tmax, tmin, min_temp, max_temp))
+    dates = [ begin_date + datetime.timedelta(index) for index in xrange(len(tasks)) ]
+    if processes > 1 and len(tasks) > 1:
+        logger.debug('interpolating %s days on %s processes', len(tasks), processes)
+        pool = multiprocessing.Pool(processes)
+        try:
+            for index in pool.imap_unordered(_interpolate_day, tasks):
+                logger.debug('interpolated %s', dates[index].isoformat())
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            logger.debug('interpolating %s points for %s', len(task[3]), dates[task[1]].isoformat())
+            _interpolate_day(task)
+    stack = stack[:len(dates)]
+    accumulate(stack, dates, previous)
+    stack.flush()
+    return stack, dates
@@ -1,15 +1,54 @@
-import json, logging, math, os, string, sys, urllib, urllib2
+import collections, gzip, hashlib, json, logging, math, multiprocessing, numpy, optparse, os, Queue, re, sqlite3, string, StringIO, sys, threading, time, urllib, urllib2, zlib
 
 mapservice_url = "http://fieldscope/ArcGIS/rest/services/budburst/surface_temp/MapServer"
 destination = "C:/Users/Administrator/Documents/UTFGrid/st_web"
+logger = logging.getLogger('utfgrid')
+# JSONP callbacks must be plain JavaScript names, so they can't inject script
+_CALLBACK = re.compile(r'[A-Za-z_$][\w$.]*\Z')
 
 class hashabledict(dict):
+  '''A dictionary usable as a set member or dictionary key. Its sorted key tuple
+and hash are computed once and kept until the dictionary is changed'''
   def __key(self):
-    return tuple((k,self[k]) for k in sorted(self))
+    cached = self.__dict__.get('_hashabledict_key')
+    if cached is None:
+      key = tuple((k,self[k]) for k in sorted(self))
+      cached = (key, hash(key))
+      self.__dict__['_hashabledict_key'] = cached
+    return cached
   def __hash__(self):
-    return hash(self.__key())
+    return self.__key()[1]
   def __eq__(self, other):
+    if self is other:
+      return True
+    if not isinstance(other, hashabledict):
+      return dict.__eq__(self, other)
     return self.__key() == other.__key()
+  def __ne__(self, other):
+    return not self.__eq__(other)
+  def __changed(self):
+    self.__dict__.pop('_hashabledict_key', None)
+  def __setitem__(self, key, value):
+    dict.__setitem__(self, key, value)
+    self.__changed()
+  def __delitem__(self, key):
+    dict.__delitem__(self, key)
+    self.__changed()
+  def clear(self):
+    dict.clear(self)
+    self.__changed()
+  def pop(self, *args):
+    self.__changed()
+    return dict.pop(self, *args)
+  def popitem(self):
+    self.__changed()
+    return dict.popitem(self)
+  def setdefault(self, key, default=None):
+    self.__changed()
+    return dict.setdefault(self, key, default)
+  def update(self, *args, **kwargs):
+    dict.update(self, *args, **kwargs)
+    self.__changed()
 
 def encode_char (index):
     index += 32
@@ -19,6 +58,13 @@ def encode_char (index):
         index += 1
     return unichr(index)
 
+def decode_chars (rows):
+    '''Return the key indexes encoded by encode_char in a list of UTFGrid rows, as
+a 2-D array'''
+    codes = numpy.frombuffer(u"".join(rows).encode('utf-32-le'), numpy.uint32).astype(numpy.int64)
+    codes = codes - (codes >= 93)
+    return (codes - 32 - (codes >= 35)).reshape(len(rows), -1)
+
 def meters_to_tile (level, mx, my):
     resolution = (2 * math.pi * 6378137 / 256) / 2**level
     origin = 2 * math.pi * 6378137 / 2.0
@@ -40,35 +86,250 @@ def tiles (level, xmin, ymin, xmax, ymax):
             my = origin - tile_size * y
             yield ((x,y,),(mx, my - tile_size, mx + tile_size, my,),)
 
-def collect_data (service, bbox, size, fields):
-    w = (bbox[2] - bbox[0]) / (size - 1)
-    h = (bbox[3] - bbox[1]) / (size - 1)
-    data_cells = {}
-    for x in xrange(size):
-        for y in xrange(size):
+def cell_size (bbox, size):
+    '''Return the width and height of the cells of a size x size grid over bbox'''
+    return (bbox[2] - bbox[0]) / (size - 1), (bbox[3] - bbox[1]) / (size - 1)
+
+def collect_data (service, bbox, size, fields, probe=0, quadtree=False):
+    '''Create the UTFGrid for one tile with an identify request per cell. If probe
+is given, a probe x probe lattice of cells that includes the corners is queried
+first, and if they all agree the tile is taken to be uniform without querying
+the rest of its cells. With quadtree, the tile is split into quarters, and
+only quarters whose corner cells disagree are split further; a block whose
+corners agree is filled without querying its other cells'''
+    w, h = cell_size(bbox, size)
+    queried = {}
+    def query (x, y):
+        if (x, y) not in queried:
             area = (bbox[0] + x * w, bbox[3] - y * h, bbox[0] + (x + 1) * w, bbox[3] - (y + 1) * h,)
-            value = query_service(service, bbox, area, size, fields)
-            if value in data_cells:
-                data_cells[value].append((x,y,))
-            else:
-                data_cells[value] = [(x,y,),]
-    grid = [[u" "] * size for i in xrange(size) ]
+            queried[(x, y)] = query_service(service, bbox, area, size, fields)
+        return queried[(x, y)]
+    if probe:
+        positions = numpy.unique(numpy.round(numpy.linspace(0, size - 1, probe)).astype(int)).tolist()
+        probed = set(query(x, y) for x in positions for y in positions)
+        if len(probed) == 1:
+            return uniform_grid(size, probed.pop())
+    cells = numpy.empty((size, size), numpy.int32)
+    values = {}
+    def fill (x0, y0, x1, y1):
+        corners = set((query(x0, y0), query(x1 - 1, y0), query(x0, y1 - 1), query(x1 - 1, y1 - 1)))
+        if len(corners) == 1:
+            cells[y0:y1, x0:x1] = values.setdefault(corners.pop(), len(values))
+        elif x1 - x0 <= 2 and y1 - y0 <= 2:
+            for x in xrange(x0, x1):
+                for y in xrange(y0, y1):
+                    cells[y, x] = values.setdefault(query(x, y), len(values))
+        else:
+            xm, ym = (x0 + x1) // 2, (y0 + y1) // 2
+            for bx0, by0, bx1, by1 in ((x0, y0, xm, ym), (xm, y0, x1, ym), (x0, ym, xm, y1), (xm, ym, x1, y1)):
+                if bx0 < bx1 and by0 < by1:
+                    fill(bx0, by0, bx1, by1)
+    if quadtree:
+        fill(0, 0, size, size)
+    else:
+        for x in xrange(size):
+            for y in xrange(size):
+                cells[y, x] = values.setdefault(query(x, y), len(values))
+    return encode_grid(cells, dict((index, value) for value, index in values.items()))
+
+def uniform_grid (size, value):
+    '''Return the UTFGrid for a tile whose cells all have the same attributes'''
+    return encode_grid(numpy.zeros((size, size), numpy.int32), { 0: value })
+
+def tile_hash (data):
+    '''Return a hash of the content of a UTFGrid tile, the same for equal tiles
+however their dictionaries are ordered'''
+    return hashlib.sha1(json.dumps(data, sort_keys=True, separators=(',', ':'))).hexdigest()
+
+def encode_grid (cells, attributes):
+    '''Encode a 2-D array of cell values as a UTFGrid. attributes maps cell values
+to the hashabledict of attributes for that value; cells whose value has no
+attributes, or empty ones, are left blank. Values with equal attributes share
+a key'''
+    values, inverse = numpy.unique(cells, return_inverse=True)
     keys = [ u"",]
     data = {}
-    key_index = 0
-    for value,cells in data_cells.items():
-        if len(value) > 0:
-            char = encode_char(len(keys))
-            key = str(key_index)
-            for cell in cells:
-                grid[cell[1]][cell[0]] = char
+    key_chars = {}
+    chars = []
+    for value in values.tolist():
+        value = attributes.get(value)
+        if not value:
+            chars.append(u" ")
+            continue
+        if value not in key_chars:
+            key = str(len(keys) - 1)
+            key_chars[value] = encode_char(len(keys))
             keys.append(key)
             data[key] = value
-            key_index += 1
-    return { "grid" : [ u"".join(row) for row in grid ],
+        chars.append(key_chars[value])
+    grid = numpy.array(chars, 'U1')[inverse].reshape(cells.shape)
+    return { "grid" : grid.view('U%d' % cells.shape[1]).ravel().tolist(),
              "keys" : keys,
              "data" : data }
 
+def decode_grid (tile, values):
+    '''Return the cells of a UTFGrid tile as a 2-D array of value ids, with -1 for
+blank cells. values maps each hashabledict of attributes to its id, and is
+extended with any new values the tile has'''
+    ids = [ -1 ]
+    for key in tile["keys"][1:]:
+        value = tile["data"].get(key)
+        ids.append(-1 if not value else values.setdefault(hashabledict(value), len(values)))
+    return numpy.array(ids)[decode_chars(tile["grid"])]
+
+def majority (cells):
+    '''Halve the resolution of a 2-D array of value ids by taking the most common
+value in each 2x2 block of cells. Ties go to a value over a blank, and then to
+the first in the block'''
+    rows, cols = cells.shape
+    blocks = [ cells[dy::2, dx::2] for dy in (0, 1) for dx in (0, 1) ]
+    best = blocks[0]
+    best_score = None
+    for block in blocks:
+        score = sum((block == other).astype(numpy.int32) for other in blocks) * 2 + (block != -1)
+        if best_score is None:
+            best, best_score = block.copy(), score
+        else:
+            better = score > best_score
+            best[better] = block[better]
+            best_score = numpy.maximum(best_score, score)
+    return best
+
+def derive_tile (store, level, x, y, size):
+    '''Create the UTFGrid for a tile from its four children at the next level in
+store, rather than from the source. Children that don't exist are blank'''
+    cells = numpy.empty((size * 2, size * 2), numpy.int64)
+    cells.fill(-1)
+    values = {}
+    for dy in (0, 1):
+        for dx in (0, 1):
+            child = store.get(level + 1, x * 2 + dx, y * 2 + dy)
+            if child is not None:
+                cells[dy * size:(dy + 1) * size, dx * size:(dx + 1) * size] = decode_grid(child, values)
+    return encode_grid(majority(cells), dict((index, value) for value, index in values.items()))
+
+def tile_cells (bbox, size):
+    '''Return the x and y coordinates of the centers of the cells of a size x size
+grid over bbox, with the same cell layout as collect_data'''
+    w, h = cell_size(bbox, size)
+    return bbox[0] + (numpy.arange(size) + 0.5) * w, bbox[3] - (numpy.arange(size) + 0.5) * h
+
+class RasterSampler(object):
+    '''Sample the cells of a UTFGrid tile directly from a local raster dataset,
+taking the value of the raster cell under the center of each grid cell.
+Attributes come from the raster's attribute table when it has one, or are the
+cell value itself as "Pixel Value", as the map service's identify returns them'''
+    def __init__ (self, raster, fields):
+        import arcpy
+        self.raster = raster
+        describe = arcpy.Describe(raster)
+        self.extent = describe.extent
+        self.cell_width = describe.meanCellWidth
+        self.cell_height = describe.meanCellHeight
+        self.rows = describe.height
+        self.cols = describe.width
+        self.attributes = None
+        table_fields = [ field.name for field in arcpy.ListFields(raster) ]
+        if 'Value' in table_fields:
+            self.attributes = {}
+            rows = arcpy.SearchCursor(raster)
+            for row in rows:
+                value = hashabledict()
+                for field in fields:
+                    if field in table_fields:
+                        value[field] = row.getValue(field)
+                self.attributes[row.getValue('Value')] = value
+            del rows
+        self.fields = fields
+
+    def sample (self, bbox, size):
+        '''Return a size x size array of raster values for the tile, and a dictionary
+of the attributes of each value'''
+        import arcpy
+        xs, ys = tile_cells(bbox, size)
+        cols = numpy.floor((xs - self.extent.XMin) / self.cell_width).astype(numpy.int64)
+        rows = numpy.floor((self.extent.YMax - ys) / self.cell_height).astype(numpy.int64)
+        col0, col1 = max(cols.min(), 0), min(cols.max() + 1, self.cols)
+        row0, row1 = max(rows.min(), 0), min(rows.max() + 1, self.rows)
+        cells = numpy.empty((size, size), numpy.float64)
+        cells.fill(numpy.nan)
+        if col0 >= col1 or row0 >= row1:
+            return cells, {}
+        if (col1 - col0) * (row1 - row0) > 16 * size * size:
+            # The tile covers far more raster cells than it samples, so resample the
+            # raster to the tile's resolution rather than read it all
+            w, h = cell_size(bbox, size)
+            arcpy.env.extent = arcpy.Extent(bbox[0], bbox[3] - size * h, bbox[0] + size * w, bbox[3])
+            resampled = 'in_memory/utfgrid_resampled'
+            arcpy.management.Resample(self.raster, resampled, w, 'NEAREST')
+            window = arcpy.RasterToNumPyArray(resampled, arcpy.Point(bbox[0], bbox[3] - size * h), size, size, numpy.nan)
+            arcpy.management.Delete(resampled)
+            arcpy.ClearEnvironment('extent')
+            cells[:window.shape[0], :window.shape[1]] = window
+        else:
+            corner = arcpy.Point(self.extent.XMin + col0 * self.cell_width, self.extent.YMax - row1 * self.cell_height)
+            window = arcpy.RasterToNumPyArray(self.raster, corner, col1 - col0, row1 - row0, numpy.nan).astype(numpy.float64)
+            inside_rows = (rows >= row0) & (rows < row1)
+            inside_cols = (cols >= col0) & (cols < col1)
+            sampled = window[numpy.clip(rows - row0, 0, row1 - row0 - 1)[:, numpy.newaxis],
+                             numpy.clip(cols - col0, 0, col1 - col0 - 1)[numpy.newaxis, :]]
+            cells = numpy.where(inside_rows[:, numpy.newaxis] & inside_cols[numpy.newaxis, :], sampled, numpy.nan)
+        attributes = {}
+        for value in numpy.unique(cells[~numpy.isnan(cells)]).tolist():
+            if self.attributes is not None:
+                attributes[value] = self.attributes.get(int(value))
+            elif 'Pixel Value' in self.fields:
+                attributes[value] = hashabledict({ 'Pixel Value': value })
+        return cells, attributes
+
+class FeatureSampler(object):
+    '''Sample the cells of a UTFGrid tile directly from a local feature class, by
+rasterizing the features that fall in the tile by object id in one pass.
+Attributes are read for every feature once, up front'''
+    def __init__ (self, features, fields):
+        import arcpy
+        self.features = features
+        self.oid_field = arcpy.Describe(features).OIDFieldName
+        self.attributes = {}
+        table_fields = [ field.name for field in arcpy.ListFields(features) ]
+        rows = arcpy.SearchCursor(features)
+        for row in rows:
+            value = hashabledict()
+            for field in fields:
+                if field in table_fields:
+                    value[field] = row.getValue(field)
+            self.attributes[row.getValue(self.oid_field)] = value
+        del rows
+
+    def sample (self, bbox, size):
+        '''Return a size x size array of object ids for the tile, with -1 where there
+are no features, and a dictionary of the attributes of each object id'''
+        import arcpy
+        w, h = cell_size(bbox, size)
+        arcpy.env.extent = arcpy.Extent(bbox[0], bbox[3] - size * h, bbox[0] + size * w, bbox[3])
+        tile = 'in_memory/utfgrid_tile'
+        try:
+            arcpy.conversion.FeatureToRaster(self.features, self.oid_field, tile, w)
+            cells = arcpy.RasterToNumPyArray(tile, arcpy.Point(bbox[0], bbox[3] - size * h), size, size, -1)
+        finally:
+            if arcpy.Exists(tile):
+                arcpy.management.Delete(tile)
+            arcpy.ClearEnvironment('extent')
+        return cells, self.attributes
+
+def open_sampler (source, fields):
+    '''Return a RasterSampler or FeatureSampler for the local dataset at source'''
+    import arcpy
+    if arcpy.Describe(source).dataType in ('RasterDataset', 'RasterLayer', 'RasterBand', 'MosaicDataset'):
+        return RasterSampler(source, fields)
+    return FeatureSampler(source, fields)
+
+def sample_data (sampler, bbox, size):
+    '''Create the UTFGrid for one tile from a local sampler, in place of one
+identify request per cell with collect_data'''
+    cells, attributes = sampler.sample(bbox, size)
+    return encode_grid(cells, attributes)
+
 def query_service (service, bounds, area, size, fields):
     data = {
         "geometryType": "esriGeometryEnvelope",
@@ -80,37 +341,602 @@ def query_service (service, bounds, area, size, fields):
         "returnGeometry": "false",
         "f": "json",
     }
-    response = json.loads(urllib2.urlopen(service + "/identify", urllib.urlencode(data)).read())
+    response = identify(service, data)
+    # Cells over the same features get the same attributes, so build each
+    # combination's dictionary once and share it
+    ids = []
+    for layer_result in response['results']:
+        attributes = layer_result['attributes']
+        oid = attributes.get('OBJECTID', attributes.get('FID', attributes.get('OID')))
+        if oid is None:
+            ids = None
+            break
+        ids.append((layer_result.get('layerId'), oid))
+    memo_key = (service, tuple(fields), tuple(ids)) if ids is not None else None
+    result = _FEATURES.get(memo_key) if memo_key is not None else None
+    if result is not None:
+        return result
     result = hashabledict()
     for layer_result in response['results']:
         for key,value in layer_result['attributes'].items():
             if key in fields:
                 result[key] = value
+    if memo_key is not None:
+        _FEATURES[memo_key] = result
     return result
 
+_FEATURES = {}
+_CACHE = None
+
+def identify (service, data):
+    '''Return the decoded response to an identify request, from the persistent
+cache if one is open and holds it'''
+    request = urllib.urlencode(sorted(data.items()))
+    if _CACHE is not None:
+        response = _CACHE.get(service, request)
+        if response is not None:
+            return response
+    text = urllib2.urlopen(service + "/identify", request).read()
+    response = json.loads(text)
+    if _CACHE is not None:
+        _CACHE.put(service, request, text)
+    return response
+
+class IdentifyCache(object):
+    '''A persistent cache of identify responses in an SQLite file, keyed by the
+service and the full request, so generating tiles again, say after a change of
+style or of the fields kept, doesn't query the service for the same cells
+again. Responses are zlib-compressed. Safe to share between threads; writes
+are committed every commit_every responses and on close. Delete the file, or
+pass refresh=True to ignore what it holds, when the data behind the service
+changes'''
+    def __init__ (self, path, refresh=False, commit_every=200):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.text_factory = str
+        self.conn.execute('CREATE TABLE IF NOT EXISTS identify (service TEXT, request TEXT, response BLOB, PRIMARY KEY (service, request))')
+        self.conn.commit()
+        self.refresh = refresh
+        self.commit_every = commit_every
+        self.hits = 0
+        self.misses = 0
+        self._uncommitted = 0
+        self._lock = threading.Lock()
+
+    def get (self, service, request):
+        if self.refresh:
+            return None
+        with self._lock:
+            row = self.conn.execute('SELECT response FROM identify WHERE service=? AND request=?', (service, request)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(zlib.decompress(str(row[0])))
+
+    def put (self, service, request, text):
+        with self._lock:
+            self.conn.execute('REPLACE INTO identify (service, request, response) VALUES (?, ?, ?)',
+                              (service, request, sqlite3.Binary(zlib.compress(text))))
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_every:
+                self.conn.commit()
+                self._uncommitted = 0
+
+    def close (self):
+        with self._lock:
+            self.conn.commit()
+            self.conn.close()
+        logger.info('identify cache: %s hits, %s misses', self.hits, self.misses)
+
+class FileStore(object):
+    '''Tiles stored as JSON files in level/x/y.json folders under root'''
+    def __init__ (self, root):
+        self.root = root
+
+    def path (self, level, x, y):
+        return os.path.join(self.root, str(level), str(x), str(y) + ".json")
+
+    def exists (self, level, x, y):
+        return os.path.exists(self.path(level, x, y))
+
+    def get (self, level, x, y):
+        path = self.path(level, x, y)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as file:
+            return json.load(file)
+
+    def put (self, level, x, y, data):
+        '''Write a tile, replacing the file only once it is complete, so a tile file
+that exists is never partly written'''
+        path = self.path(level, x, y)
+        folder = os.path.dirname(path)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(path + ".tmp", "w") as file:
+            file.write(json.dumps(data, indent=2))
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(path + ".tmp", path)
+
+    def close (self):
+        pass
+
+class DedupStore(object):
+    '''Tiles stored once per distinct content: each unique grid is written as a
+compact JSON blob named by its hash under blobs/, and index.txt maps each
+"level/x/y" to the hash of its blob, one line per tile stored. Uniform and
+empty tiles, which cover much of most extents, all share a handful of blobs'''
+    def __init__ (self, root):
+        self.root = root
+        self.index = {}
+        self.blobs = 0
+        if not os.path.exists(root):
+            os.makedirs(root)
+        index_path = os.path.join(root, "index.txt")
+        if os.path.exists(index_path):
+            with open(index_path, "r") as file:
+                for line in file:
+                    parts = line.split()
+                    if len(parts) == 2:
+                        self.index[tuple(int(part) for part in parts[0].split("/"))] = parts[1]
+        self.file = open(index_path, "a")
+
+    def blob_path (self, digest):
+        return os.path.join(self.root, "blobs", digest[:2], digest + ".json")
+
+    def exists (self, level, x, y):
+        return (level, x, y) in self.index
+
+    def get (self, level, x, y):
+        digest = self.index.get((level, x, y))
+        if digest is None:
+            return None
+        with open(self.blob_path(digest), "r") as file:
+            return json.load(file)
+
+    def put (self, level, x, y, data):
+        digest = tile_hash(data)
+        path = self.blob_path(digest)
+        if not os.path.exists(path):
+            folder = os.path.dirname(path)
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            with open(path + ".tmp", "w") as file:
+                file.write(json.dumps(data, sort_keys=True, separators=(',', ':')))
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(path + ".tmp", path)
+            self.blobs += 1
+        self.index[(level, x, y)] = digest
+        self.file.write("%d/%d/%d %s\n" % (level, x, y, digest))
+        self.file.flush()
+
+    def close (self):
+        self.file.close()
+        logger.info('%s tiles stored, %s new blobs written', len(self.index), self.blobs)
+
+def gzip_bytes (data):
+    buffer = StringIO.StringIO()
+    file = gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0)
+    file.write(data)
+    file.close()
+    return buffer.getvalue()
+
+def gunzip_bytes (data):
+    return gzip.GzipFile(fileobj=StringIO.StringIO(data), mode='rb').read()
+
+def meters_to_lonlat (mx, my):
+    origin = 2 * math.pi * 6378137 / 2.0
+    lon = mx / origin * 180.0
+    lat = math.degrees(2 * math.atan(math.exp(my / 6378137.0)) - math.pi / 2)
+    return lon, lat
+
+class MBTilesStore(object):
+    '''Tiles stored in a single SQLite file in the MBTiles 1.1 layout for
+UTFGrids: each tile's grid and keys as gzip-compressed compact JSON in the
+grids table, and its data in the grid_data table, one row per key. Rows are
+numbered from the south, as MBTiles requires. Tiles are written in batches of
+batch_size per transaction.
+
+The store is also its own manifest, since a tile is recorded as done in the
+same transaction that stores it, so a run interrupted before a batch commits
+renders that batch again'''
+    def __init__ (self, path, metadata=None, batch_size=500):
+        self.path = path
+        self.batch_size = batch_size
+        self.conn = sqlite3.connect(path)
+        self.conn.text_factory = str
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT, PRIMARY KEY (name))')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB,
+                                                             PRIMARY KEY (zoom_level, tile_column, tile_row))''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS grids (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, grid BLOB,
+                                                             PRIMARY KEY (zoom_level, tile_column, tile_row))''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS grid_data (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER,
+                                                                 key_name TEXT, key_json TEXT,
+                                                                 PRIMARY KEY (zoom_level, tile_column, tile_row, key_name))''')
+        if metadata:
+            self.conn.executemany('REPLACE INTO metadata (name, value) VALUES (?, ?)', metadata.items())
+        self.conn.commit()
+        self.tiles = set()
+        for level, x, row in self.conn.execute('SELECT zoom_level, tile_column, tile_row FROM grids'):
+            self.tiles.add((level, x, (2 ** level - 1) - row))
+        self.pending = []
+
+    def exists (self, level, x, y):
+        return (level, x, y) in self.tiles
+
+    def get (self, level, x, y):
+        if self.pending:
+            self.flush()
+        return read_mbtiles_grid(self.conn, level, x, y)
+
+    def put (self, level, x, y, data):
+        self.pending.append((level, x, y, data))
+        self.tiles.add((level, x, y))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush (self):
+        if not self.pending:
+            return
+        grids = []
+        grid_data = []
+        for level, x, y, data in self.pending:
+            row = (2 ** level - 1) - y
+            grid = json.dumps({ "grid": data["grid"], "keys": data["keys"] }, separators=(',', ':'))
+            grids.append((level, x, row, sqlite3.Binary(gzip_bytes(grid))))
+            for key, value in data["data"].items():
+                grid_data.append((level, x, row, key, json.dumps(value, sort_keys=True, separators=(',', ':'))))
+        with self.conn:
+            self.conn.executemany('DELETE FROM grid_data WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                                  [ grid[:3] for grid in grids ])
+            self.conn.executemany('REPLACE INTO grids (zoom_level, tile_column, tile_row, grid) VALUES (?, ?, ?, ?)', grids)
+            self.conn.executemany('INSERT INTO grid_data (zoom_level, tile_column, tile_row, key_name, key_json) VALUES (?, ?, ?, ?, ?)', grid_data)
+        self.pending = []
+
+    def __contains__ (self, tile):
+        return tile in self.tiles
+
+    def add (self, tile):
+        pass
+
+    def close (self):
+        self.flush()
+        self.conn.close()
+
+def read_mbtiles_grid (conn, level, x, y):
+    '''Return the UTFGrid for a tile from an open MBTiles connection, or None'''
+    row = (2 ** level - 1) - y
+    result = conn.execute('SELECT grid FROM grids WHERE zoom_level=? AND tile_column=? AND tile_row=?', (level, x, row)).fetchone()
+    if result is None:
+        return None
+    data = json.loads(gunzip_bytes(str(result[0])))
+    data["data"] = dict((key, json.loads(value)) for key, value in
+                        conn.execute('SELECT key_name, key_json FROM grid_data WHERE zoom_level=? AND tile_column=? AND tile_row=?', (level, x, row)))
+    return data
+
+class MBTilesReader(object):
+    '''Serves UTFGrid tiles from an MBTiles file. Can be used as a WSGI application
+answering GET /level/x/y.json (or .grid.json), optionally with a callback
+parameter for JSONP. Responses are gzip-compressed for clients that accept it'''
+    def __init__ (self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def connection (self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.text_factory = str
+            self._local.conn = conn
+        return conn
+
+    def get (self, level, x, y):
+        return read_mbtiles_grid(self.connection(), level, x, y)
+
+    def __call__ (self, environ, start_response):
+        parts = environ.get('PATH_INFO', '').strip('/').split('/')
+        try:
+            level, x, y = int(parts[0]), int(parts[1]), int(parts[2].split('.')[0])
+        except (IndexError, ValueError):
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [ 'not found' ]
+        callback = dict(pair.split('=', 1) for pair in environ.get('QUERY_STRING', '').split('&') if '=' in pair).get('callback')
+        if callback:
+            callback = urllib.unquote(callback)
+            if not _CALLBACK.match(callback):
+                start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+                return [ 'invalid callback' ]
+        data = self.get(level, x, y)
+        if data is None:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [ 'not found' ]
+        body = json.dumps(data, separators=(',', ':'))
+        content_type = 'application/json'
+        if callback:
+            body = '%s(%s);' % (callback, body)
+            content_type = 'text/javascript'
+        headers = [('Content-Type', content_type), ('Access-Control-Allow-Origin', '*')]
+        if 'gzip' in environ.get('HTTP_ACCEPT_ENCODING', ''):
+            body = gzip_bytes(body)
+            headers.append(('Content-Encoding', 'gzip'))
+        headers.append(('Content-Length', str(len(body))))
+        start_response('200 OK', headers)
+        return [ body ]
+
+def serve (path, port=8080):
+    '''Serve the tiles in the MBTiles file at path over HTTP on the given port'''
+    from wsgiref.simple_server import make_server
+    logger.info('serving %s on port %s', path, port)
+    make_server('', port, MBTilesReader(path)).serve_forever()
+
+class Manifest(object):
+    '''A record of the tiles completed so far, one "level/x/y" line each, appended
+as each tile is stored so that an interrupted run resumes where it stopped'''
+    def __init__ (self, path):
+        self.path = path
+        self.tiles = set()
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                for line in file:
+                    parts = line.strip().split("/")
+                    if len(parts) == 3:
+                        self.tiles.add(tuple(int(part) for part in parts))
+        self.file = open(path, "a")
+
+    def __contains__ (self, tile):
+        return tile in self.tiles
+
+    def __len__ (self):
+        return len(self.tiles)
+
+    def add (self, tile):
+        self.tiles.add(tile)
+        self.file.write("%d/%d/%d\n" % tile)
+        self.file.flush()
+
+    def close (self):
+        self.file.close()
+
+_DONE = object()
+
+def pool_map (handler, items, workers=8, processes=False):
+    '''Call handler on each of items using a pool of worker threads, or of worker
+processes if processes is True, with no more than twice as many items queued as
+there are workers. Yields an (item, result, error) tuple for each item as it
+completes, where error is the exception handler raised for that item, if any.
+Results are consumed on the calling thread'''
+    if processes:
+        pool = multiprocessing.Pool(workers)
+        pending = collections.deque()
+        def collect (item, result):
+            try:
+                return (item, result.get(), None)
+            except Exception, err:
+                return (item, None, err)
+        try:
+            for item in items:
+                pending.append((item, pool.apply_async(handler, (item,))))
+                while len(pending) >= workers * 2:
+                    yield collect(*pending.popleft())
+            while pending:
+                yield collect(*pending.popleft())
+        finally:
+            pool.terminate()
+            pool.join()
+        return
+    tasks = Queue.Queue(workers * 2)
+    results = Queue.Queue(workers * 2)
+    def work ():
+        while True:
+            item = tasks.get()
+            if item is _DONE:
+                break
+            try:
+                results.put((item, handler(item), None))
+            except Exception, err:
+                results.put((item, None, err))
+        results.put(_DONE)
+    def feed ():
+        for item in items:
+            tasks.put(item)
+        for i in xrange(workers):
+            tasks.put(_DONE)
+    threads = [ threading.Thread(target=feed) ]
+    threads.extend(threading.Thread(target=work) for i in xrange(workers))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    running = workers
+    while running > 0:
+        result = results.get()
+        if result is _DONE:
+            running -= 1
+        else:
+            yield result
+
+_SAMPLERS = {}
+
+def render_tile (task):
+    '''Create the UTFGrid for one tile, from the map service or, if source is
+given, from a local sampler opened once per worker. Runs on a worker thread or
+process, so takes all of its arguments as a single picklable tuple'''
+    level, tile, bbox, source, fields, size, probe, quadtree = task
+    if source is None:
+        return collect_data(mapservice_url, bbox, size, fields, probe, quadtree)
+    key = (source, tuple(fields))
+    if key not in _SAMPLERS:
+        _SAMPLERS[key] = open_sampler(source, fields)
+    return sample_data(_SAMPLERS[key], bbox, size)
+
+def intersect (a, b):
+    '''Return the intersection of two (xmin, ymin, xmax, ymax) boxes, or None'''
+    box = (max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3]),)
+    if box[0] >= box[2] or box[1] >= box[3]:
+        return None
+    return box
+
 def main (argv=None):
+    '''Usage: <script> [options]
+create UTFGrid tiles for the map service, or with --source by sampling a
+local raster or feature class (in Web Mercator) directly, which needs arcpy
+but makes no identify requests. Tiles are rendered on a pool of worker
+threads, or of worker processes for a local source, and each completed tile
+is recorded in manifest.txt in the destination folder, so an interrupted run
+picks up where it stopped. --min-level, --max-level and --bbox restrict the
+run to a range of zoom levels and a region, given in Web Mercator meters.
+With --pyramid, only the tiles at --max-level are rendered from the source,
+and each coarser level is derived from the one below it by majority sampling
+each 2x2 block of cells. The deepest level then covers the whole footprint of
+the --min-level tiles over the region, so every derived tile is complete;
+a tile with a child that failed to render is left for a later run to derive.
+With --probe N, tiles from the map service are first probed on an N x N
+lattice of cells, and taken to be uniform without further requests if every
+probe agrees; features smaller than the lattice spacing can be missed, so
+probing is off by default. With --store dedup, each distinct tile is stored once, as a compact
+blob named by its hash, with an index mapping tiles to blobs, and with
+--store mbtiles, all tiles go gzip-compressed into one MBTiles file,
+destination/utfgrid.mbtiles, which --serve PORT serves over HTTP.
+Identify responses are kept in destination/identify.db, so cells are only
+queried again after --refresh-cache, and --quadtree fills blocks of cells
+whose corners agree without querying the cells inside them.'''
+    global _CACHE
+    parser = optparse.OptionParser(usage=main.__doc__)
+    parser.add_option('-s', '--source', help='local raster or feature class to sample instead of the map service')
+    parser.add_option('-f', '--fields', default='Class', help='comma separated attribute fields to include')
+    parser.add_option('-d', '--destination', default=destination, help='folder to write tiles to')
+    parser.add_option('--min-level', type='int', default=0, help='first zoom level to render')
+    parser.add_option('--max-level', type='int', default=18, help='last zoom level to render')
+    parser.add_option('-b', '--bbox', help='xmin,ymin,xmax,ymax of the region to render')
+    parser.add_option('--size', type='int', default=128, help='cells across each tile')
+    parser.add_option('-w', '--workers', type='int', default=8, help='number of worker threads or processes')
+    parser.add_option('-p', '--pyramid', action='store_true', default=False,
+                      help='render only --max-level from the source and derive coarser levels from it')
+    parser.add_option('--probe', type='int', default=0,
+                      help='cells across a lattice probed for a uniform tile before querying every cell '
+                           '(default 0, off); lossy, since a feature lying between the probed cells is dropped')
+    parser.add_option('--store', type='choice', choices=['files', 'dedup', 'mbtiles'], default='files',
+                      help='write one JSON file per tile (files), one blob per distinct tile plus an index (dedup), '
+                           'or gzip-compressed tiles in the single file destination/utfgrid.mbtiles (mbtiles)')
+    parser.add_option('-q', '--quadtree', action='store_true', default=False,
+                      help='only query cells inside blocks whose corner cells disagree')
+    parser.add_option('--no-cache', action='store_true', default=False,
+                      help="don't keep identify responses in destination/identify.db")
+    parser.add_option('--refresh-cache', action='store_true', default=False,
+                      help='query the service again for every cell, replacing cached responses')
+    parser.add_option('--serve', type='int', metavar='PORT',
+                      help='serve the tiles in destination/utfgrid.mbtiles on PORT instead of creating tiles')
+    options, args = parser.parse_args(argv or [])
+    fields = options.fields.split(',')
     # Set up basic logging to stdout
     logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', 
                         level=logging.DEBUG)
-    if not os.path.exists(destination):
-        os.makedirs(destination)
-    config = json.loads(urllib2.urlopen(mapservice_url + "?f=json").read())
-    wkid = config['spatialReference']['wkid']
-    if not (wkid == 102113 or wkid == 102100):
+    if not os.path.exists(options.destination):
+        os.makedirs(options.destination)
+    mbtiles_path = os.path.join(options.destination, "utfgrid.mbtiles")
+    if options.serve:
+        serve(mbtiles_path, options.serve)
+        return 0
+    if options.source:
+        import arcpy
+        describe = arcpy.Describe(options.source)
+        wkid = describe.spatialReference.factoryCode
+        full_extent = (describe.extent.XMin, describe.extent.YMin, describe.extent.XMax, describe.extent.YMax,)
+    else:
+        config = json.loads(urllib2.urlopen(mapservice_url + "?f=json").read())
+        wkid = config['spatialReference']['wkid']
+        full_extent = (config['fullExtent']['xmin'], config['fullExtent']['ymin'],
+                       config['fullExtent']['xmax'], config['fullExtent']['ymax'],)
+    if not (wkid == 102113 or wkid == 102100 or wkid == 3857):
         raise Exception('Map service must be in Web Mercator projection')
-    tile_size = (256,256,)
-    full_extent = (config['fullExtent']['xmin'], config['fullExtent']['ymin'],
-                   config['fullExtent']['xmax'], config['fullExtent']['ymax'],)
-    for level in xrange(0, 19):
-        for tile,bbox in tiles(level, *full_extent):
-            folder = os.path.join(os.path.join(destination, str(level)), str(tile[0]))
-            if not os.path.exists(folder):
-                os.makedirs(folder)
-            file_path = os.path.join(folder, str(tile[1]) + ".json")
-            if not os.path.exists(file_path):
-                data = collect_data(mapservice_url, bbox, 128, ['Class'])
-                with open(file_path, "w") as file:
-                    file.write(json.dumps(data, indent=2))
+    extent = full_extent
+    if options.bbox:
+        extent = intersect(full_extent, tuple(float(value) for value in options.bbox.split(',')))
+        if extent is None:
+            raise Exception('bbox %s does not overlap the data' % options.bbox)
+    source_levels = range(options.min_level, options.max_level + 1)
+    source_extent = extent
+    if options.pyramid:
+        source_levels = [ options.max_level ]
+        # Render the children of every tile the coarsest level will need
+        footprint = [ bbox for tile,bbox in tiles(options.min_level, *extent) ]
+        source_extent = intersect(full_extent, (min(bbox[0] for bbox in footprint) + 0.001, min(bbox[1] for bbox in footprint) + 0.001,
+                                                max(bbox[2] for bbox in footprint) - 0.001, max(bbox[3] for bbox in footprint) - 0.001,))
+    if options.store == 'mbtiles':
+        west, south = meters_to_lonlat(extent[0], extent[1])
+        east, north = meters_to_lonlat(extent[2], extent[3])
+        metadata = { 'name': os.path.basename(options.source or mapservice_url),
+                     'type': 'overlay',
+                     'version': '1.1',
+                     'description': 'UTFGrid tiles of %s' % ', '.join(fields),
+                     'format': 'png',
+                     'minzoom': str(options.min_level),
+                     'maxzoom': str(options.max_level),
+                     'bounds': '%f,%f,%f,%f' % (west, south, east, north) }
+        store = MBTilesStore(mbtiles_path, metadata)
+        manifest = store
+    elif options.store == 'dedup':
+        store = DedupStore(options.destination)
+        manifest = Manifest(os.path.join(options.destination, "manifest.txt"))
+    else:
+        store = FileStore(options.destination)
+        manifest = Manifest(os.path.join(options.destination, "manifest.txt"))
+    if not options.source and not options.no_cache:
+        _CACHE = IdentifyCache(os.path.join(options.destination, "identify.db"), options.refresh_cache)
+    def tasks ():
+        for level in source_levels:
+            for tile,bbox in tiles(level, *source_extent):
+                if (level,) + tile in manifest or store.exists(level, *tile):
+                    continue
+                yield (level, tile, bbox, options.source, fields, options.size, options.probe, options.quadtree)
+    count = 0
+    start = time.time()
+    try:
+        for task, data, error in pool_map(render_tile, tasks(), options.workers, processes=bool(options.source)):
+            level, tile = task[0], task[1]
+            if error is not None:
+                logger.error('error rendering tile %s/%s/%s: %s', level, tile[0], tile[1], error)
+                continue
+            store.put(level, tile[0], tile[1], data)
+            manifest.add((level,) + tile)
+            count += 1
+            if count % 100 == 0:
+                logger.info('rendered %s tiles (%.1f tiles/sec), now at level %s', count, count / (time.time() - start), level)
+        if options.pyramid:
+            for level in xrange(options.max_level - 1, options.min_level - 1, -1):
+                derived = 0
+                incomplete = 0
+                children = set(tile for tile,bbox in tiles(level + 1, *source_extent))
+                for tile,bbox in tiles(level, *source_extent):
+                    if (level,) + tile in manifest:
+                        continue
+                    # A tile derived with a child missing would have a blank
+                    # quarter, and would never be derived again once it is in
+                    # the manifest, so leave it for the run that fills the child
+                    missing = [ child for child in ((tile[0] * 2 + dx, tile[1] * 2 + dy) for dy in (0, 1) for dx in (0, 1))
+                                if child in children and (level + 1,) + child not in manifest
+                                and not store.exists(level + 1, *child) ]
+                    if missing:
+                        incomplete += 1
+                        continue
+                    store.put(level, tile[0], tile[1], derive_tile(store, level, tile[0], tile[1], options.size))
+                    manifest.add((level,) + tile)
+                    derived += 1
+                logger.info('derived %s tiles at level %s', derived, level)
+                if incomplete:
+                    logger.warning('skipped %s tiles at level %s with missing children; run again to derive them', incomplete, level)
+    finally:
+        if manifest is not store:
+            manifest.close()
+        store.close()
+        if _CACHE is not None:
+            _CACHE.close()
+            _CACHE = None
+    logger.info('rendered %s tiles in %.1f seconds', count, time.time() - start)
+    return 0
 
 if __name__ == "__main__":
     status = main(sys.argv[1:])
@@ -4,8 +4,20 @@
 #   (generated by ArcGIS/ModelBuilder)
 # ---------------------------------------------------------------------------
 
+# Needs ArcGIS 10.1 or later: grids, clipped tiles and vertex labels are read
+# and written with arcpy.da cursors. Grids written as Esri JSON need no ArcGIS.
+
 # Import system modules
-import sys, string, os, arcpy, arcgisscripting
+import sys, string, os, itertools, json, math, multiprocessing, numpy, time
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+def require_da ():
+    if arcpy is None or not hasattr(arcpy, 'da'):
+        raise Exception('FeatureCache needs ArcGIS 10.1 or later, for arcpy.da')
+
 
 class TileInfo:
     def __init__(self, dpi, width, height, originX, originY, lods, spatialReference):
@@ -29,50 +41,138 @@ def vertex_index (col, row):
     return -(((col & 0xFFFF) << 16) + (row & 0xFFFF))
 
 
-def create_grid (tileInfo, level, feature_class):
-    spatial_ref = arcpy.SpatialReference("C:/Program Files (x86)/ArcGIS/Desktop10.0/Coordinate Systems/Projected Coordinate Systems/World/WGS 1984 Web Mercator (Auxiliary Sphere).prj")
-    spatial_ref.setMDomain(-137434824702, 0)
-    arcpy.env.overwriteOutput = True
-    arcpy.CreateFeatureclass_management(os.path.dirname(feature_class), 
-                                        os.path.basename(feature_class),
-                                        "POLYGON", 
-                                        "#", 
-                                        "ENABLED", 
-                                        "DISABLED", 
-                                        spatial_ref)
+def grid_range (tileInfo, level, extent=None):
+    '''Return the (first column, last column + 1, first row, last row + 1) of the
+tiles of the given level, limited to the tiles that overlap extent, an
+(xmin, ymin, xmax, ymax) tuple, if it is given'''
     lod = tileInfo.lods[level]
     width = tileInfo.width * lod.resolution
     height = tileInfo.height * lod.resolution
-    maxX = -(tileInfo.originX + width)
-    minY = -(tileInfo.originY - height)
-    cursor = arcpy.InsertCursor(feature_class)
-    ring = arcpy.Array()
-    point = arcpy.Point()
-    x = tileInfo.originX
-    colNum = 0
-    while (x < maxX):
-        y = tileInfo.originY
-        rowNum = 0
-        while (y > minY):
-            point.ID, point.X, point.Y, point.M = (0, x, y, vertex_index(colNum, rowNum))
-            ring.add(point)
-            point.ID, point.X, point.Y, point.M = (1, x + width, y, vertex_index(colNum + 1, rowNum))
-            ring.add(point)
-            point.ID, point.X, point.Y, point.M = (2, x + width, y - height, vertex_index(colNum + 1, rowNum + 1))
-            ring.add(point)
-            point.ID, point.X, point.Y, point.M = (3, x, y - height, vertex_index(colNum, rowNum + 1))
-            ring.add(point)
-            point.ID, point.X, point.Y, point.M = (4, x, y, vertex_index(colNum, rowNum))
-            ring.add(point)
-            feat = cursor.newRow()
-            feat.shape = arcpy.Polygon(ring)
-            cursor.insertRow(feat)
-            ring.removeAll()
-            y = y - height
-            rowNum = rowNum + 1
-        x = x + width
-        colNum = colNum + 1
-    del cursor
+    # The grid is symmetric about 0, 0
+    cols = int(round(-2 * tileInfo.originX / width))
+    rows = int(round(2 * tileInfo.originY / height))
+    if extent is None:
+        return (0, cols, 0, rows)
+    xmin, ymin, xmax, ymax = extent
+    col0 = max(0, int(math.floor((xmin - tileInfo.originX) / width)))
+    col1 = min(cols, int(math.ceil((xmax - tileInfo.originX) / width)))
+    row0 = max(0, int(math.floor((tileInfo.originY - ymax) / height)))
+    row1 = min(rows, int(math.ceil((tileInfo.originY - ymin) / height)))
+    return (col0, max(col0, col1), row0, max(row0, row1))
+
+
+def grid_blocks (tileInfo, level, extent=None, block_size=65536):
+    '''Yield the tiles of the given level in blocks of about block_size tiles, as
+arrays of the tiles' columns and rows and a (tiles, 5, 3) array of the x, y and
+M values of each tile's ring, starting at its top left corner and running
+clockwise. M values are the vertex_index of each corner'''
+    lod = tileInfo.lods[level]
+    width = tileInfo.width * lod.resolution
+    height = tileInfo.height * lod.resolution
+    col0, col1, row0, row1 = grid_range(tileInfo, level, extent)
+    if col1 <= col0 or row1 <= row0:
+        return
+    # Offsets of the corners from a tile's column and row
+    corner_cols = numpy.array([ 0, 1, 1, 0, 0 ])
+    corner_rows = numpy.array([ 0, 0, 1, 1, 0 ])
+    block_cols = max(1, block_size // (row1 - row0))
+    for first in xrange(col0, col1, block_cols):
+        cols, rows = numpy.meshgrid(numpy.arange(first, min(first + block_cols, col1), dtype=numpy.int64),
+                                    numpy.arange(row0, row1, dtype=numpy.int64))
+        cols = cols.T.ravel()
+        rows = rows.T.ravel()
+        vertex_cols = cols[:, numpy.newaxis] + corner_cols
+        vertex_rows = rows[:, numpy.newaxis] + corner_rows
+        coords = numpy.empty((len(cols), 5, 3))
+        coords[:, :, 0] = tileInfo.originX + vertex_cols * width
+        coords[:, :, 1] = tileInfo.originY - vertex_rows * height
+        coords[:, :, 2] = vertex_index(vertex_cols, vertex_rows)
+        yield cols, rows, coords
+
+
+_RING = '[[' + ','.join([ '[%.6f,%.6f,%d]' ] * 5) + ']]'
+
+def ring_json (coords):
+    '''Return the Esri JSON rings of each of a (tiles, 5, 3) array of tile rings'''
+    return [ _RING % tuple(values) for values in coords.reshape(len(coords), 15).tolist() ]
+
+
+class FeatureClassWriter:
+    '''Writes tiles to a new polygon feature class with M values, with their
+column and row in the TILE_COL and TILE_ROW fields'''
+    def __init__(self, feature_class, spatial_ref):
+        require_da()
+        arcpy.env.overwriteOutput = True
+        arcpy.CreateFeatureclass_management(os.path.dirname(feature_class),
+                                            os.path.basename(feature_class),
+                                            "POLYGON",
+                                            "#",
+                                            "ENABLED",
+                                            "DISABLED",
+                                            spatial_ref)
+        arcpy.AddField_management(feature_class, "TILE_COL", "LONG")
+        arcpy.AddField_management(feature_class, "TILE_ROW", "LONG")
+        self.feature_class = feature_class
+        self.geometry = '{"hasM":true,"rings":%%s,"spatialReference":{"wkid":%d}}' % spatial_ref.factoryCode
+        self.cursor = arcpy.da.InsertCursor(feature_class, [ "SHAPE@JSON", "TILE_COL", "TILE_ROW" ])
+
+    def write (self, cols, rows, coords):
+        for rings, col, row in zip(ring_json(coords), cols.tolist(), rows.tolist()):
+            self.cursor.insertRow((self.geometry % rings, col, row))
+
+    def close (self):
+        del self.cursor
+        # clip_parallel selects each chunk's tiles by TILE_COL and TILE_ROW
+        arcpy.AddIndex_management(self.feature_class, "TILE_COL;TILE_ROW", "TILE_IDX")
+
+
+class JsonWriter:
+    '''Writes tiles to an Esri JSON feature set file, which needs no ArcGIS to
+write and can be loaded with JSONToFeatures_conversion'''
+    def __init__(self, path, wkid):
+        self.file = open(path, 'w')
+        self.file.write('{"geometryType":"esriGeometryPolygon","hasM":true,"spatialReference":{"wkid":%d},'
+                        '"fields":[{"name":"TILE_COL","type":"esriFieldTypeInteger"},'
+                        '{"name":"TILE_ROW","type":"esriFieldTypeInteger"}],"features":[\n' % wkid)
+        self.first = True
+
+    def write (self, cols, rows, coords):
+        features = [ '{"attributes":{"TILE_COL":%d,"TILE_ROW":%d},"geometry":{"rings":%s}}' % (col, row, rings)
+                     for rings, col, row in zip(ring_json(coords), cols.tolist(), rows.tolist()) ]
+        if features:
+            if not self.first:
+                self.file.write(',\n')
+            self.file.write(',\n'.join(features))
+            self.first = False
+
+    def close (self):
+        self.file.write('\n]}\n')
+        self.file.close()
+
+
+def create_grid (tileInfo, level, feature_class, extent=None, block_size=65536):
+    '''Write the tiles of the given level to feature_class, or to an Esri JSON
+file if feature_class ends with .json. extent limits the grid to the tiles over
+the data: an (xmin, ymin, xmax, ymax) tuple or a dataset whose extent to use.
+Returns the number of tiles written'''
+    if isinstance(extent, basestring):
+        extent = arcpy.Describe(extent).extent
+        extent = (extent.XMin, extent.YMin, extent.XMax, extent.YMax)
+    if feature_class.lower().endswith('.json'):
+        writer = JsonWriter(feature_class, tileInfo.spatialReference)
+    else:
+        require_da()
+        spatial_ref = arcpy.SpatialReference(tileInfo.spatialReference)
+        spatial_ref.setMDomain(-137434824702, 0)
+        writer = FeatureClassWriter(feature_class, spatial_ref)
+    count = 0
+    try:
+        for cols, rows, coords in grid_blocks(tileInfo, level, extent, block_size):
+            writer.write(cols, rows, coords)
+            count += len(cols)
+    finally:
+        writer.close()
+    return count
 
 
 def copy_to_m (in_fc, out_fc):
@@ -85,39 +185,310 @@ def copy_to_m (in_fc, out_fc):
     arcpy.Append_management(in_fc, out_fc)
     
 
-def label_vertices (feature_class, first_index=0):
-    shape_name = arcpy.Describe(feature_class).shapeFieldName
-    rows = arcpy.UpdateCursor(feature_class)
+def label_rings (rings, first_index=0):
+    '''Return a copy of a list of Esri JSON rings with the M value of each vertex
+set to consecutive indices from first_index, along with the next index'''
+    counts = [ len(ring) for ring in rings ]
+    if not counts:
+        return [], first_index
+    coords = numpy.empty((sum(counts), 3))
+    coords[:, :2] = [ vertex[:2] for ring in rings for vertex in ring ]
+    coords[:, 2] = numpy.arange(first_index, first_index + len(coords))
+    labeled = []
+    start = 0
+    for count in counts:
+        labeled.append(coords[start:start + count].tolist())
+        start += count
+    return labeled, first_index + len(coords)
+
+
+def label_vertices (feature_class, first_index=0, progress=0):
+    '''Set the M value of every vertex in feature_class, which must have M values
+enabled, to consecutive indices from first_index, in the order of the features
+and of their rings. Prints a count of the vertices labeled every progress
+features, if progress is given, and the rate at the end. Returns the next
+index'''
+    require_da()
+    start = time.time()
     index = first_index
+    features = 0
+    rows = arcpy.da.UpdateCursor(feature_class, [ "SHAPE@JSON" ])
     for row in rows:
-        polygon = row.getValue(shape_name)
-        for part_index in range(0, polygon.partCount):
-            ring = polygon.getPart(part_index)
-            point = ring.next()
-            while point:
-                print point
-                point.M = index
-                print point
-                index += 1
-                point = ring.next()
-                if not point:
-                    point = ring.next()
-        rows.updateRow(row)
+        polygon = json.loads(row[0])
+        polygon["rings"], index = label_rings(polygon.get("rings", []), index)
+        polygon["hasM"] = True
+        rows.updateRow((json.dumps(polygon),))
+        features += 1
+        if progress and features % progress == 0:
+            print "%d features, %d vertices" % (features, index - first_index)
     del rows
+    elapsed = time.time() - start
+    print "labeled %d vertices of %d features in %.1f seconds (%.0f vertices/sec)" % (
+        index - first_index, features, elapsed, (index - first_index) / max(elapsed, 1e-6))
+    return index
+
+
+class GridIndex:
+    '''A spatial index that hashes the extents of items, as (xmin, ymin, xmax,
+ymax) tuples, into the cells of a regular grid with its top left corner at
+originX, originY'''
+    def __init__(self, cell_size, originX=0.0, originY=0.0):
+        self.cell_size = cell_size
+        self.originX = originX
+        self.originY = originY
+        self.cells = {}
 
-def simplify_and_clip (input_fc, grid_fc, max_offset, output_workspace):
+    def _cells (self, extent):
+        xmin, ymin, xmax, ymax = extent
+        col0 = int(math.floor((xmin - self.originX) / self.cell_size))
+        col1 = max(col0, int(math.ceil((xmax - self.originX) / self.cell_size)) - 1)
+        row0 = int(math.floor((self.originY - ymax) / self.cell_size))
+        row1 = max(row0, int(math.ceil((self.originY - ymin) / self.cell_size)) - 1)
+        for col in xrange(col0, col1 + 1):
+            for row in xrange(row0, row1 + 1):
+                yield (col, row)
+
+    def insert (self, key, extent):
+        for cell in self._cells(extent):
+            self.cells.setdefault(cell, []).append(key)
+
+    def query (self, extent):
+        '''Return the keys of the items whose cells overlap extent, in the order
+they were inserted'''
+        keys = set()
+        for cell in self._cells(extent):
+            keys.update(self.cells.get(cell, ()))
+        return sorted(keys)
+
+
+def extent_tuple (extent):
+    return (extent.XMin, extent.YMin, extent.XMax, extent.YMax)
+
+
+def clip_tiles (features, tiles, index):
+    '''Yield (column, row, attributes, geometry) for each piece of the features
+inside each of the tiles. features maps keys in index to (geometry,
+attributes) pairs, and tiles yields (column, row, polygon) for each tile. Only
+the features index finds near a tile are intersected with it'''
+    for col, row, tile in tiles:
+        for key in index.query(extent_tuple(tile.extent)):
+            geometry, attributes = features[key]
+            if geometry.disjoint(tile):
+                continue
+            clipped = geometry.intersect(tile, 4)
+            if clipped.area > 0:
+                yield col, row, attributes, clipped
+
+
+def set_environment ():
     arcpy.env.MDomain = "-137434824702 137434824702"
     arcpy.env.outputMFlag = "Enabled"
+    arcpy.env.overwriteOutput = True
+
+
+def simplify (input_fc, max_offset, output_fc):
+    set_environment()
     arcpy.env.scratchWorkspace = "C:/Documents and Settings/Administrator/My Documents/ArcGIS/Default.gdb"
-    arcpy.SimplifyPolygon_cartography(input_fc, "input_temp", "POINT_REMOVE", max_offset, max_offset * max_offset * 0.5, "RESOLVE_ERRORS", "NO_KEEP")
-    arcpy.MakeFeatureLayer_management(grid_fc, "grid_temp")
-    desc = arcpy.Describe("grid_temp")
-    rows = arcpy.SearchCursor("grid_temp")
-    index = 0
-    for row in rows:
-        arcpy.SelectLayerByAttribute_management("grid_temp", "NEW_SELECTION", "%s = %s" % (desc.OIDFieldName, row.getValue(desc.OIDFieldName)))
-        arcpy.Intersect_analysis("input_temp;grid_temp", "%s/%s" % (output_workspace, index))
-        index += 1
+    arcpy.SimplifyPolygon_cartography(input_fc, output_fc, "POINT_REMOVE", max_offset, max_offset * max_offset * 0.5, "RESOLVE_ERRORS", "NO_KEEP")
+
+
+def simplify_pyramid (input_fc, tileInfo, workspace, levels=None, refresh=False):
+    '''Simplify the polygons of input_fc for each of the given levels of tileInfo
+(all of them by default) to the level's resolution, as <input>_simplified_<level>
+in workspace, and return a dictionary of the feature class for each level. The
+finest level is simplified from input_fc and each coarser level from the level
+below it, so only the first pass works on full resolution geometry. Levels
+already in workspace are reused unless refresh is True; once a level is
+simplified again, every coarser level is too, since each is derived from the
+one below it'''
+    if levels is None:
+        levels = range(len(tileInfo.lods))
+    levels = sorted(levels, key=lambda level: tileInfo.lods[level].resolution)
+    name = os.path.splitext(os.path.basename(input_fc))[0]
+    pyramid = {}
+    source = input_fc
+    for level in levels:
+        output_fc = os.path.join(workspace, arcpy.ValidateTableName("%s_simplified_%d" % (name, level), workspace))
+        if refresh or not arcpy.Exists(output_fc):
+            simplify(source, tileInfo.lods[level].resolution, output_fc)
+            print "simplified level %d from %s" % (level, source)
+            refresh = True
+        pyramid[level] = output_fc
+        source = output_fc
+    return pyramid
+
+
+def attribute_fields (feature_class):
+    return [ field.name for field in arcpy.ListFields(feature_class)
+             if field.editable and field.type not in ("OID", "Geometry") ]
+
+
+def create_output (output_fc, template, spatial_ref):
+    arcpy.CreateFeatureclass_management(os.path.dirname(output_fc),
+                                        os.path.basename(output_fc),
+                                        "POLYGON",
+                                        template,
+                                        "ENABLED",
+                                        "DISABLED",
+                                        spatial_ref)
+    arcpy.AddField_management(output_fc, "TILE_COL", "LONG")
+    arcpy.AddField_management(output_fc, "TILE_ROW", "LONG")
+
+
+def clip_to (simplified_fc, grid_fc, output_fc, where=None, extent=None):
+    '''Clip the polygons of simplified_fc to the tiles of grid_fc, a grid made by
+create_grid, writing every tile's pieces of the polygons to output_fc with the
+tile's TILE_COL and TILE_ROW. where limits the tiles, and extent, an (xmin,
+ymin, xmax, ymax) tuple that covers them, the polygons read to those that
+overlap it. Returns the number of pieces written'''
+    require_da()
+    fields = attribute_fields(simplified_fc)
+    create_output(output_fc, simplified_fc, arcpy.Describe(grid_fc).spatialReference)
+    tiles = arcpy.da.SearchCursor(grid_fc, [ "TILE_COL", "TILE_ROW", "SHAPE@" ], where)
+    try:
+        first = tiles.next()
+    except StopIteration:
+        return 0
+    # Hash the features into cells the size of the first tile, aligned with the grid
+    tile_extent = first[2].extent
+    index = GridIndex(tile_extent.width, tile_extent.XMin, tile_extent.YMax)
+    source = simplified_fc
+    if extent is None:
+        extent = extent_tuple(arcpy.Describe(grid_fc).extent)
+    else:
+        source = arcpy.MakeFeatureLayer_management(simplified_fc, "clip_features").getOutput(0)
+        arcpy.SelectLayerByLocation_management(source, "INTERSECT", arcpy.Extent(*extent).polygon)
+    features = {}
+    for row in arcpy.da.SearchCursor(source, [ "OID@", "SHAPE@" ] + fields):
+        features[row[0]] = (row[1], row[2:])
+        # Hash only the part of the feature inside the tiles, not all the
+        # cells a large polygon spans
+        xmin, ymin, xmax, ymax = extent_tuple(row[1].extent)
+        index.insert(row[0], (max(xmin, extent[0]), max(ymin, extent[1]),
+                              min(xmax, extent[2]), min(ymax, extent[3])))
+    cursor = arcpy.da.InsertCursor(output_fc, [ "TILE_COL", "TILE_ROW", "SHAPE@" ] + fields)
+    count = 0
+    for col, row, attributes, clipped in clip_tiles(features, itertools.chain([ first ], tiles), index):
+        cursor.insertRow((col, row, clipped) + attributes)
+        count += 1
+    del cursor, tiles
+    if source is not simplified_fc:
+        arcpy.Delete_management(source)
+    return count
+
+
+def clip_chunk (task):
+    '''Clip the tiles of one chunk of the grid into a file geodatabase of its own
+in folder. Runs in a worker process'''
+    key, simplified_fc, grid_fc, where, extent, folder = task
+    set_environment()
+    workspace = os.path.join(folder, "chunk_%d_%d.gdb" % key)
+    if arcpy.Exists(workspace):
+        arcpy.Delete_management(workspace)
+    arcpy.CreateFileGDB_management(folder, os.path.basename(workspace))
+    return key, clip_to(simplified_fc, grid_fc, os.path.join(workspace, "clipped"), where, extent)
+
+
+def read_manifest (path):
+    '''Return a dictionary of the number of pieces written for each chunk listed
+as finished in the manifest at path'''
+    done = {}
+    if os.path.exists(path):
+        for line in open(path, 'r'):
+            values = line.split()
+            if len(values) == 3:
+                done[(int(values[0]), int(values[1]))] = int(values[2])
+    return done
+
+
+def clip_parallel (simplified_fc, grid_fc, output_fc, work_folder, processes=None, chunk_tiles=16):
+    '''Clip the polygons of simplified_fc to the tiles of grid_fc on a pool of
+processes, a chunk of chunk_tiles by chunk_tiles tiles at a time, then merge the
+chunks into output_fc. Finished chunks are recorded in work_folder, and are not
+clipped again if the run is interrupted and restarted'''
+    require_da()
+    set_environment()
+    for col, row, shape in arcpy.da.SearchCursor(grid_fc, [ "TILE_COL", "TILE_ROW", "SHAPE@" ]):
+        tile_extent = shape.extent
+        originX = tile_extent.XMin - col * tile_extent.width
+        originY = tile_extent.YMax + row * tile_extent.height
+        break
+    else:
+        raise Exception("%s has no tiles" % grid_fc)
+    chunk_width = chunk_tiles * tile_extent.width
+    chunk_height = chunk_tiles * tile_extent.height
+    chunks = set()
+    for col, row in arcpy.da.SearchCursor(grid_fc, [ "TILE_COL", "TILE_ROW" ]):
+        chunks.add((col // chunk_tiles, row // chunk_tiles))
+    manifest_path = os.path.join(work_folder, "manifest.txt")
+    done = read_manifest(manifest_path)
+    tasks = []
+    for key in sorted(chunks):
+        if key not in done:
+            col0, row0 = key[0] * chunk_tiles, key[1] * chunk_tiles
+            where = "TILE_COL >= %d AND TILE_COL < %d AND TILE_ROW >= %d AND TILE_ROW < %d" % (col0, col0 + chunk_tiles, row0, row0 + chunk_tiles)
+            extent = (originX + key[0] * chunk_width, originY - (key[1] + 1) * chunk_height,
+                      originX + (key[0] + 1) * chunk_width, originY - key[1] * chunk_height)
+            tasks.append((key, simplified_fc, grid_fc, where, extent, work_folder))
+    print "%d of %d chunks already clipped" % (len(chunks) - len(tasks), len(chunks))
+    if tasks:
+        pool = multiprocessing.Pool(processes)
+        manifest = open(manifest_path, 'a')
+        try:
+            for key, count in pool.imap_unordered(clip_chunk, tasks):
+                done[key] = count
+                manifest.write("%d %d %d\n" % (key[0], key[1], count))
+                manifest.flush()
+                os.fsync(manifest.fileno())
+                print "%d of %d chunks clipped" % (len(done), len(chunks))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            manifest.close()
+    outputs = [ os.path.join(work_folder, "chunk_%d_%d.gdb" % key, "clipped")
+                for key in sorted(done) if done[key] > 0 ]
+    if outputs:
+        arcpy.Merge_management(outputs, output_fc)
+    else:
+        create_output(output_fc, simplified_fc, arcpy.Describe(grid_fc).spatialReference)
+    return sum(done.values())
+
+
+def simplify_and_clip (input_fc, grid_fc, max_offset, output_fc, processes=1, work_folder=None, simplified=False):
+    '''Simplify the polygons of input_fc to max_offset and clip them to the tiles
+of grid_fc, a grid made by create_grid, writing every tile's pieces of the
+polygons to output_fc with the tile's TILE_COL and TILE_ROW. With more than one
+process the tiles are clipped in parallel, keeping the simplified polygons and
+the progress of the run in work_folder (by default beside output_fc's
+workspace) so that an interrupted run picks up where it left off; delete
+work_folder to start again from scratch. If simplified is True, input_fc is
+already simplified, as by simplify_pyramid, and is clipped as it is. Returns the
+number of pieces written'''
+    if processes > 1:
+        set_environment()
+        if work_folder is None:
+            workspace = os.path.dirname(output_fc)
+            work_folder = os.path.join(os.path.dirname(workspace), "%s_work" % os.path.basename(output_fc))
+        if not os.path.exists(work_folder):
+            os.makedirs(work_folder)
+        simplified_fc = input_fc
+        if not simplified:
+            simplified_fc = os.path.join(work_folder, "simplified.gdb", "simplified")
+            if not arcpy.Exists(simplified_fc):
+                arcpy.CreateFileGDB_management(work_folder, "simplified.gdb")
+                simplify(input_fc, max_offset, simplified_fc)
+        count = clip_parallel(simplified_fc, grid_fc, output_fc, work_folder, processes)
+    elif simplified:
+        set_environment()
+        count = clip_to(input_fc, grid_fc, output_fc)
+    else:
+        simplify(input_fc, max_offset, "input_temp")
+        count = clip_to("input_temp", grid_fc, output_fc)
+    arcpy.AddIndex_management(output_fc, "TILE_COL;TILE_ROW", "TILE_IDX")
+    return count
 
 
 #labelVertices("C:/Documents and Settings/Administrator/My Documents/ArcGIS/Default.gdb/counties_m")
@@ -136,7 +507,26 @@ create_grid(tileInfo, 2, "C:/Documents and Settings/Administrator/My Documents/A
 create_grid(tileInfo, 3, "C:/Documents and Settings/Administrator/My Documents/ArcGIS/Default.gdb/Grid2_3")
 '''
 
-simplify_and_clip("C:/Documents and Settings/Administrator/My Documents/ArcGIS/Default.gdb/test",
-                  "C:/Documents and Settings/Administrator/My Documents/ArcGIS/Default.gdb/Grid2_2",
-                  39135.758482,
-                  "C:/Documents and Settings/Administrator/My Documents/ArcGIS/Default.gdb")
\ No newline at end of file
+def main ():
+    tileInfo = TileInfo(dpi=96, width=256, height=256, originX=-20037508.342787, originY=20037508.342787,
+                        lods = [
+                            LOD(level=0, resolution=156543.033928, scale=591657527.591555),
+                            LOD(level=1, resolution=78271.5169639999, scale=295828763.795777),
+                            LOD(level=2, resolution=39135.7584820001, scale = 147914381.897889),
+                            LOD(level=3, resolution=19567.8792409999, scale=73957190.948944)
+                        ],
+                        spatialReference=102100)
+    pyramid = simplify_pyramid("C:/Documents and Settings/Administrator/My Documents/ArcGIS/Default.gdb/test",
+                               tileInfo,
+                               "C:/Documents and Settings/Administrator/My Documents/ArcGIS/Default.gdb")
+    simplify_and_clip(pyramid[2],
+                      "C:/Documents and Settings/Administrator/My Documents/ArcGIS/Default.gdb/Grid2_2",
+                      tileInfo.lods[2].resolution,
+                      "C:/Documents and Settings/Administrator/My Documents/ArcGIS/Default.gdb/test_2",
+                      processes=multiprocessing.cpu_count(),
+                      simplified=True)
+
+
+# Worker processes import this module, so only run when it is the main script
+if __name__ == "__main__":
+    main()
\ No newline at end of file